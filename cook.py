@@ -22,70 +22,328 @@ ePubChef - generating EPUB files for eBooks
 # and include "mybook_recipe.txt" which contains necessary meta-data.
 # Run with: python cook.py mybook  # if your book is called 'mybook'.
 # Optional second arguments are "debug", or "validate", or "kindlegen" eg. python cook.py demo validate
+# or "pos" and "stamp" for personalized copies, eg. python cook.py demo pos, then for each
+# sale: python cook.py demo stamp path/to/pos_data.txt
+# "batch" stamps one copy per record of a JSON (an array, or JSON lines) or multi-document YAML file,
+# eg. python cook.py demo batch sales.jsonl (records are mappings, each transaction_id may only
+# appear once and is letters, digits, _, . and -, as it names the .epub)
+# "--jobs N" cooks chapters in N worker processes, eg. python cook.py demo --jobs 4
+# "--incremental" only cooks chapters whose scenes, recipe entry, template or cook.py
+# changed since the last --incremental cook and leaves unchanged images, fonts and css in place.
+# "watch" cooks, then cooks again (incrementally) each time the raw book changes,
+# eg. python cook.py demo watch
+# "--template-cache" keeps parsed templates in template_cache.pickle for the next run
+# images, fonts and css are hard linked into the cooked folder where possible,
+# "--copy-assets" copies them instead
+# "--stream" writes straight into the .epub, no <book>_cooked folder is needed
+# "--deterministic" cooks the same bytes from the same inputs (see zipInfo), the sha256
+# of the .epub is written to <book>.epub.sha256
+# compressed assets, optimised images and epubcheck results are cached in asset_cache/ next to
+# cook.py, "--cache-dir DIR" (or the EPUBCHEF_CACHE_DIR environment variable) caches elsewhere
+# "--validate" checks the .epub (or each stamped copy, or each book of a catalog) as
+# "validate" does, eg. python cook.py demo batch sales.jsonl --validate (see validateEpubs)
+# "bench" times the slow parts of the cook against the book, eg. python cook.py demo bench
+# (--save-baseline keeps the timings, later benches report regressions against them),
+# (chapters are written straight to xhtml while chapter.xhtml is the stock template,
+# bench checks that gives the same xhtml, and exits 1 if it does not),
+# "synth" writes a synthetic book to bench with, eg. python cook.py big synth --chapters 200
+# (see writeSyntheticBook, bench takes the same options)
+# "serve" cooks, then serves personalized copies over HTTP on localhost, eg.
+# python cook.py demo serve --port 8000 --workers 4 --queue 16 (see serveBooks)
+# "profile" cooks under cProfile and writes debug/cook.pstats, every cook writes
+# the time, cpu, memory and counts of each stage and chapter to debug/stage_report.json
+# ("--trace-memory" adds each stage's peak python allocations, but cooks slower)
+# "catalog" cooks many books in worker processes, skipping books which have not changed,
+# eg. python cook.py books.txt catalog --jobs 4, or python cook.py path/to/books catalog
+# (see cookCatalog)
+# each cook logs to cook_log.txt, or "--log FILE" (eg. --log demo_log.txt to keep the logs of
+# books cooked at the same time apart), "--log-level debug" logs (and prints) every chapter,
+# table, image and asset, "--log-json" logs JSON lines to cook_log.jsonl (see msg)
+# tests are in tests/, run them with: python -m pytest tests
+# From python: from cook import Kitchen; Kitchen('demo').cook() (see class Kitchen)
 
 # debug populates a /debug directory, validate runs EPUB check if it has been set up (Java, etc.)
 # Output generated to the directory "demo_cooked" and the epub (and .mobi) to "demo_served".
 
-import pystache
 import os
 import sys
 from os.path import isfile, join
-import glob
 import shutil
 import pprint
 import codecs
-import yaml
 import re
 import json
 import zipfile
 import subprocess
-import markdown
 import datetime
+import pickle
+import multiprocessing
+import time
+import hashlib
+import zlib
+import threading
+import io
+import html
+import contextlib
+import collections
+import atexit
+import platform
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+try:
+    import resource # for peak memory, not on windows
+except ImportError:
+    resource = None
+# pystache, yaml and markdown are imported where they are first used, so
+# importing cook.py (eg. for the Kitchen class) is quick.
 
 cook_dir = os.path.dirname(os.path.realpath(__file__))
 
-# not using python logging module to reduce external dependencies
-log = open(join(cook_dir, "cook_log.txt"), 'w')
-log.write("****starting to cook***** at " + str(datetime.datetime.now()) + " (Ireland time)\r\n")
+# not using python logging module to reduce external dependencies.
+# msg() formats the message, prints it and adds it to log_lines, a background
+# thread writes those to the log a few times a second, so cooking never waits
+# for the disk. Messages below log_level are not formatted at all: pass the
+# values separately, eg. msg("chapter: %s", code, level=DEBUG), and a hot loop
+# costs a comparison.
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+level_names = {DEBUG: 'debug', INFO: 'info', WARNING: 'warning', ERROR: 'error'}
+log_level = INFO
+log = None          # the file (or io.StringIO, to keep the log in memory) being logged to
+log_owned = False   # opened by openLog, so closed by closeLog
+log_json = False    # one JSON object per line rather than plain text
+log_lines = collections.deque() # lines waiting to be written
+log_lock = threading.Lock()     # held while writing them
+log_stop = None     # set by closeLog to stop the writer thread
+log_writer = None   # the thread
+log_pid = None      # process which opened the log, forked workers write for themselves
+log_interval = 0.2  # seconds between writes
+echo = True # print messages as well as logging them, catalog workers only log
+
+def openLog(log_loc, json_lines=False, level='info'):
+    # log to log_loc, a file name or a file object, eg. Kitchen(..., log_file=io.StringIO())
+    global log, log_owned, log_json, log_level, log_lines, log_lock, log_stop, log_writer, log_pid
+    if log_pid == os.getpid():
+        closeLog()
+    # else a log inherited from the parent process, which keeps writing it
+    log_level = dict([(name, number) for number, name in level_names.items()])[level.lower()]
+    log_json = json_lines
+    log_owned = isinstance(log_loc, str)
+    if log_owned:
+        log_dir = os.path.dirname(os.path.abspath(log_loc))
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        log = open(log_loc, 'w')
+    else:
+        log = log_loc
+    log_pid = os.getpid()
+    log_lines = collections.deque()
+    log_lock = threading.Lock()
+    log_stop = threading.Event()
+    log_writer = threading.Thread(target = writeLog, name = 'log writer')
+    log_writer.daemon = True
+    log_writer.start()
+    if not log_json:
+        log_lines.append("****starting to cook***** at " + str(datetime.datetime.now()) + " (Ireland time)\r\n")
+
+def writeLog():
+    # the log writer thread
+    while not log_stop.wait(log_interval):
+        flushLog()
+    flushLog()
+
+def flushLog():
+    # write the lines logged so far, eg. so worker processes don't inherit them unwritten
+    if log and log_pid == os.getpid():
+        with log_lock:
+            batch = []
+            while log_lines:
+                batch.append(log_lines.popleft())
+            if batch:
+                log.write(''.join(batch))
+                log.flush()
+
+def closeLog():
+    # write what is left and close the log, also run at exit
+    global log, log_writer, log_pid
+    if log and log_pid == os.getpid():
+        log_stop.set()
+        log_writer.join()
+        if log_owned:
+            log.close()
+    log = log_writer = log_pid = None
+
+def msg(msg_txt, *args, level=INFO):
+    if level < log_level:
+        return
+    if args:
+        msg_txt = msg_txt % args
+    if echo:
+        print(msg_txt)
+    if log:
+        if log_json:
+            line = json.dumps({'time': datetime.datetime.now().isoformat(), 'level': level_names[level],
+                               'pid': os.getpid(), 'book': file_name, 'msg': msg_txt}) + "\n"
+        else:
+            line = "\r\n" + msg_txt
+        if log_pid == os.getpid():
+            log_lines.append(line)
+        elif log_owned: # a forked worker, the writer thread is in the parent
+            os.write(log.fileno(), line.encode('utf-8'))
+        else:
+            log.write(line)
 
-def msg(msg_txt):
-    print(msg_txt)
-    log.write("\r\n" + msg_txt)
+atexit.register(closeLog)
 
 template_dir = "templates"
 
-# get the recipe file for the book
-file_name = sys.argv[1]
-gen_dir = os.path.join(cook_dir, file_name+'_cooked')
-
-# check for a debug level and validate run
-arg2 = None
-try:
-    arg2 = sys.argv[2]
-except:
-    pass
-
-msg('cook_dir: '+ cook_dir)
-
-dirs = {
-    'gen_dir' : gen_dir, # folder for the ePub files
-    'template_dir' : os.path.join(cook_dir, 'templates'),         # templates for ePub files
-    'raw_book' : os.path.join(cook_dir, file_name+'_raw'), # words and images of the book
-    'oebps' : os.path.join(cook_dir, gen_dir+'/OEBPS'),
-    'raw_images' : os.path.join(cook_dir, file_name+'_raw'+'/images'),
-    'images' : os.path.join(cook_dir, gen_dir+'/OEBPS/images'),
-    'default_cover' : os.path.join(cook_dir, 'demo_raw/images'),
-    'content' : os.path.join(cook_dir, gen_dir+'/OEBPS/content'),
-    'css' : os.path.join(cook_dir, 'css'),
-    'tmp' : os.path.join(cook_dir, 'debug'),
-    'epub_loc' : os.path.join(cook_dir, file_name+'_served'),
-    'fonts' : os.path.join(cook_dir, 'fonts'),
-    'fonts_gen' : os.path.join(cook_dir, gen_dir+'/OEBPS/fonts'),
-    'demo_raw' : os.path.join(cook_dir, 'demo_raw'),
-    'recipe_loc' : os.path.join(cook_dir, file_name+'_raw', file_name+'_recipe.txt'),
-    'raw_css' : os.path.join(cook_dir, file_name+'_raw', 'css'),
-	}
+# options such as "--jobs 4" can go anywhere after the book name,
+# the remaining arguments are read by position.
+# options followed by a value
+value_options = ['jobs', 'port', 'workers', 'queue', # see setupBook and serveBooks
+                 'log', 'log-level', # see openLog
+                 'epubcheck', # see validateEpubs
+                 'cache-dir', # see setupBook
+                 'chapters', 'scenes', 'paras', 'images', 'parts', 'markdown', 'repeat', 'tolerance'] # see runBenchmarks
+# options which are on when given
+flag_options = ['stream', 'incremental', 'deterministic', 'copy-assets', 'template-cache', # see setupBook
+                'trace-memory', 'log-json', 'validate', 'force', 'save-baseline']
+
+# value options which must be numbers
+int_options = ['jobs', 'port', 'workers', 'queue', 'chapters', 'scenes', 'paras', 'images', 'parts', 'repeat']
+float_options = ['markdown', 'tolerance']
+# the lowest and highest value of each, None for no limit
+option_bounds = {'jobs': (1, None), 'port': (1, 65535), 'workers': (1, None), 'queue': (0, None),
+                 'chapters': (1, None), 'scenes': (1, None), 'paras': (1, None), 'images': (0, None),
+                 'parts': (0, None), 'repeat': (1, None), 'markdown': (0, 1), 'tolerance': (0, None)}
+
+def argsError(error):
+    msg("***ERROR, "+ error +"***", level=ERROR)
+    raise SystemExit(2)
+
+def parseArgs(argv):
+    # returns the arguments and the options, stops with a message for a bad option
+    options = {}
+    args = []
+    arg_nbr = 1
+    while arg_nbr < len(argv):
+        if argv[arg_nbr].startswith('--'):
+            option = argv[arg_nbr][2:]
+            if option in value_options:
+                arg_nbr+=1
+                if arg_nbr >= len(argv):
+                    argsError("--"+ option +" needs a value")
+                options[option] = argv[arg_nbr]
+            elif option in flag_options:
+                options[option] = True
+            else:
+                argsError("unknown option --"+ option)
+        else:
+            args.append(argv[arg_nbr])
+        arg_nbr+=1
+    for option in options:
+        try:
+            if option in int_options:
+                value = int(options[option])
+            elif option in float_options:
+                value = float(options[option])
+            else:
+                continue
+        except ValueError:
+            argsError("--"+ option +" must be a number, not: "+ options[option])
+        lowest, highest = option_bounds[option]
+        if value < lowest or (highest is not None and value > highest):
+            argsError("--%s must be %s, not: %s" % (option, "from %s to %s" % (lowest, highest)
+                      if highest is not None else "at least %s" % lowest, options[option]))
+    if options.get('log-level', 'info').lower() not in level_names.values():
+        argsError("--log-level must be one of: "+ ", ".join(sorted(level_names.values())))
+    if not args:
+        argsError("no book, eg. python cook.py demo")
+    return args, options
+
+# the book being cooked and how, set by setupBook
+file_name = None
+arg2 = None   # debug, validate, pos, ...
+arg3 = None   # eg. the point of sale file for "stamp"
+options = {}
+book_dir = cook_dir # where <book>_raw, _cooked and _served are
+jobs = 1
+streaming = False
+incremental = False
+deterministic = False
+dirs = {}
+trace_dir = None
+
+def setupBook(_file_name, _arg2=None, _arg3=None, _options={}, _book_dir=None):
+    global file_name, arg2, arg3, options, book_dir, jobs, streaming, incremental, deterministic, dirs, trace_dir
+    # get the recipe file for the book
+    file_name = _file_name
+    arg2 = _arg2
+    arg3 = _arg3
+    options = dict(_options)
+    book_dir = _book_dir or cook_dir
+    gen_dir = os.path.join(book_dir, file_name+'_cooked')
+
+    # number of worker processes for cooking chapters
+    jobs = int(options.get('jobs', 1))
+
+    # write straight into the .epub, without a <book>_cooked folder
+    streaming = options.get('stream', False)
+
+    # only cook again what changed since the last cook
+    incremental = options.get('incremental', False)
+    if streaming and arg2 in ['pos', 'batch', 'watch', 'serve']:
+        streaming = False # these keep using the cooked folder
+    if streaming and incremental:
+        msg("--incremental needs the cooked folder, ignored with --stream")
+        incremental = False
+
+    # the same .epub, byte for byte, from the same inputs (see zipInfo)
+    deterministic = bool(options.get('deterministic')) or 'SOURCE_DATE_EPOCH' in os.environ
+
+    # the stage report adds the peak of python's allocations in each stage (see memoryStarted)
+    if options.get('trace-memory') and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    # shared by every book cooked with this cook.py, unless --cache-dir (or EPUBCHEF_CACHE_DIR) says otherwise
+    cache_dir = os.path.abspath(options.get('cache-dir') or os.environ.get('EPUBCHEF_CACHE_DIR')
+                                or os.path.join(cook_dir, 'asset_cache'))
+
+    dirs = {
+        'gen_dir' : gen_dir, # folder for the ePub files
+        'template_dir' : os.path.join(cook_dir, 'templates'),         # templates for ePub files
+        'raw_book' : os.path.join(book_dir, file_name+'_raw'), # words and images of the book
+        'oebps' : os.path.join(gen_dir, 'OEBPS'),
+        'raw_images' : os.path.join(book_dir, file_name+'_raw'+'/images'),
+        'images' : os.path.join(gen_dir, 'OEBPS/images'),
+        'default_cover' : os.path.join(cook_dir, 'demo_raw/images'),
+        'content' : os.path.join(gen_dir, 'OEBPS/content'),
+        'css' : os.path.join(cook_dir, 'css'),
+        'tmp' : os.path.join(book_dir, 'debug'),
+        'epub_loc' : os.path.join(book_dir, file_name+'_served'),
+        'fonts' : os.path.join(cook_dir, 'fonts'),
+        'fonts_gen' : os.path.join(gen_dir, 'OEBPS/fonts'),
+        'demo_raw' : os.path.join(cook_dir, 'demo_raw'),
+        'recipe_loc' : os.path.join(book_dir, file_name+'_raw', file_name+'_recipe.txt'),
+        'raw_css' : os.path.join(book_dir, file_name+'_raw', 'css'),
+        'pos_data' : os.path.join(book_dir, file_name+'_raw', file_name+'_pos_data.txt'),
+        'pos_base' : os.path.join(gen_dir, 'pos_base.epub'), # archive without point of sale pages
+        'pos_recipe' : os.path.join(gen_dir, 'pos_recipe.pickle'), # recipe used to stamp pos pages
+        'build_manifest' : os.path.join(gen_dir, 'build_manifest.json'), # hashes of what was cooked
+        'template_cache' : os.path.join(cook_dir, 'template_cache.pickle'), # parsed templates
+        'asset_cache' : cache_dir, # compressed images and fonts
+        'image_cache' : os.path.join(cache_dir, 'images'), # optimised images
+        'validation_cache' : os.path.join(cache_dir, 'validation'), # epubcheck results
+        'bench_baseline' : os.path.join(book_dir, 'bench_baselines', file_name+'.json'), # timings to compare with
+    	}
+
+    # folder for the debug trace of each chapter's paragraphs, None when not debugging
+    trace_dir = None
+    if arg2 == 'debug':
+        trace_dir = dirs['tmp']
 
+def bookSettings():
+    # what worker processes need to call setupBook for the same book
+    return (file_name, arg2, arg3, options, book_dir)
 
 ''' structure to be generated for "mybook" is:
   /mybook_generated (generated book root dir)
@@ -118,7 +376,7 @@ dirs = {
      mybook_recipe.txt
      _0010_010_scene....txt (many scene files)
   /mybook_raw/images
-     ...jpg *
+     ...jpg, png, gif *
   /mybook_raw/fonts
      ...,odt, woff
   /templates
@@ -141,20 +399,78 @@ Each item in the list contains "words" and optionally a "text_class." For exampl
 
 paragraphs are items in a dictionary called "paras". Each item is either a "textblock"
 of which there can be many, or a "class" which defines the xhtml class of the paragraph.
+
+Scenes are made of Paragraph objects which look the same to templates (a paragraph
+is its own, only, textblock) but take far less memory than the dictionaries.
 '''
-renderer = pystache.Renderer()
+renderer = None # pystache.Renderer, made on first use
+
+# parsed templates, keyed by path, with the file's modification time so an
+# edited template is parsed again. --template-cache keeps them in a pickle
+# between runs so a cold start skips parsing too.
+parsed_templates = {}
+template_stats = {} # template name: [renders, seconds]
+template_cache_loaded = False
+template_cache_changed = False
+
+def loadTemplate(template_path):
+    global template_cache_loaded, template_cache_changed
+    if options.get('template-cache') and not template_cache_loaded:
+        template_cache_loaded = True
+        try:
+            with open(dirs['template_cache'], 'rb') as f:
+                parsed_templates.update(pickle.load(f))
+        except:
+            pass # no cache yet, or one from another version
+
+    mtime = os.stat(template_path).st_mtime_ns
+    if template_path in parsed_templates and parsed_templates[template_path][0] == mtime:
+        return parsed_templates[template_path][1]
+    import pystache
+    with codecs.open(template_path, 'r', 'utf-8') as f:
+        parsed = pystache.parse(f.read())
+    parsed_templates[template_path] = (mtime, parsed)
+    template_cache_changed = True
+    return parsed
+
+def saveTemplateCache():
+    global template_cache_changed
+    if options.get('template-cache') and template_cache_changed:
+        with open(dirs['template_cache'], 'wb') as f:
+            pickle.dump(parsed_templates, f)
+        template_cache_changed = False
+
+def renderTemplate(template_name, context):
+    # render a template from the templates folder, parsing it only once
+    global renderer
+    if renderer is None:
+        import pystache
+        renderer = pystache.Renderer()
+    started = time.perf_counter()
+    out = renderer.render(loadTemplate(join(dirs['template_dir'], template_name)), context)
+    if template_name not in template_stats:
+        template_stats[template_name] = [0, 0.0]
+    template_stats[template_name][0] +=1
+    template_stats[template_name][1] += time.perf_counter() - started
+    return out
+
+def logTemplateStats():
+    for template_name in sorted(template_stats):
+        renders, seconds = template_stats[template_name]
+        msg("template %s: %d renders in %.1fms", template_name, renders, seconds * 1000, level=DEBUG)
 
 def importYaml(file_name):
+    import yaml
     recipe_loc = dirs['recipe_loc']
     if os.path.isfile(recipe_loc):
         msg('Opening recipe for: '+ recipe_loc)
         try:
             with open(recipe_loc, 'r') as f:
-                _recipe = yaml.load(f)
+                _recipe = yaml.safe_load(f)
         except:
-            msg('\n***Error in recipe file, please check your yaml*** : '+ recipe_loc)
-            msg('***Try checking it with http://yaml-online-parser.appspot.com***')
-            msg('***Escape characters such as colons by adding quotes around the text.***\n')
+            msg('\n***Error in recipe file, please check your yaml*** : '+ recipe_loc, level=ERROR)
+            msg('***Try checking it with http://yaml-online-parser.appspot.com***', level=ERROR)
+            msg('***Escape characters such as colons by adding quotes around the text.***\n', level=ERROR)
             raise SystemExit
     else: # create a new recipe from a template
         msg('NO RECIPE FOUND AT: '+ recipe_loc)
@@ -165,12 +481,12 @@ def importYaml(file_name):
             os.makedirs(dirs['raw_book'])
             f = open(join(dirs['raw_book'], file_name+'_recipe.txt'), 'w')
 
-        new_recipe = renderer.render_path(os.path.join(dirs['template_dir'], 'recipe.mustache'), dict([("file_name", file_name)]))
+        new_recipe = renderTemplate('recipe.mustache', dict([("file_name", file_name)]))
 
         f.write(new_recipe)
         f.close()
         with open(join(dirs['raw_book'], file_name+'_recipe.txt'), 'r') as f:
-            _recipe = yaml.load(f)
+            _recipe = yaml.safe_load(f)
 
     # augment recipe by adding the file name to it
     _recipe['file_name'] = file_name
@@ -184,7 +500,7 @@ def createEmptyDir(dir_nm, add_init):
         os.makedirs(dir_nm)
     else:
         # delete contents if it already existed
-        msg('deleting previously generated contents of directory: '+  dir_nm)
+        msg('deleting previously generated contents of directory: %s', dir_nm, level=DEBUG)
         shutil.rmtree(dir_nm)
         try:
             os.makedirs(dir_nm)
@@ -194,42 +510,43 @@ def createEmptyDir(dir_nm, add_init):
         f = open(os.path.join(dir_nm, '__init__.py'),'w+')
         f.close()
 
-def prepareDirs(dirs):
+def prepareDirs(dirs, image_sources={}):
+    # image_sources maps raw images to the optimised images to use instead
     # delete previous generated folders
     if arg2 == 'debug':
         msg('RUNNING in DEBUG mode, see folder: /'+ dirs['tmp'])
-        #os.makedirs(dirs['tmp'])
-        f = open(os.path.join(dirs['tmp'], 'tmp_paras.json'), 'w')
-        f.close()
-        f = open(os.path.join(dirs['tmp'],'tmp_all_paras.json'), 'w')
-        f.close()
 
-    # top level generated book dir
-    createEmptyDir(dirs['gen_dir'],False)
+    if isinstance(output, ZipOutput):
+        streamAssets(dirs, image_sources)
+        return {}
 
-    # main content
     content_dir = dirs['content']
-    createEmptyDir(content_dir,False)
+    if incremental:
+        # keep what was cooked last time, only changed files are copied
+        if not os.path.exists(content_dir):
+            os.makedirs(content_dir)
+    else:
+        # top level generated book dir
+        createEmptyDir(dirs['gen_dir'],False)
 
-    # images including cover image
-    try:
-        shutil.copytree(dirs['raw_images'], dirs['images'])
-    except: # create ..._raw and ..._raw/images if they don't exist
-        os.makedirs(dirs['raw_images'])
-        src = os.path.join(dirs['demo_raw'], 'images', 'cover_image.jpg')
-        #src = 'demo_raw/images/cover_image.jpg'
-        shutil.copyfile(src, dirs['raw_images']+'/cover_image.jpg')
+        # main content
+        createEmptyDir(content_dir,False)
+
+    # images, fonts and css are linked or copied by stageFiles, all at once
+    staged_files = []
+    def copyTree(src, dst):
+        syncTree(src, dst, staged_files = staged_files)
 
-        # try again now that chapters and cover image has been created
-        shutil.copytree(dirs['raw_images'], dirs['images'])
+    # images including cover image
+    checkRawImages(dirs)
+    copyTree(dirs['raw_images'], dirs['images'])
 
 	# ePubChef creation image
-    src = os.path.join(dirs['template_dir'], 'epubchef_logo.jpg')
-    dst = os.path.join(dirs['oebps'],'images', 'epubchef_logo.jpg')
-    shutil.copyfile(src, dst)
+    staged_files.append((os.path.join(dirs['template_dir'], 'epubchef_logo.jpg'),
+                         os.path.join(dirs['oebps'], 'images', 'epubchef_logo.jpg')))
 
     # fonts
-    shutil.copytree(dirs['fonts'], dirs['fonts_gen'])
+    copyTree(dirs['fonts'], dirs['fonts_gen'])
     # try:
         # shutil.copytree(dirs['fonts'], dirs['fonts_gen'])
     # except: # create ..._raw and ..._raw/fonts if they don't exist
@@ -241,7 +558,7 @@ def prepareDirs(dirs):
 
     # css
     css_dst = os.path.join(dirs['oebps'],'css')
-    shutil.copytree(dirs['css'], css_dst)
+    copyTree(dirs['css'], css_dst)
 
     # TODO fix permission error here
     #dst = os.path.join(dirs['oebps'],'css')
@@ -251,14 +568,240 @@ def prepareDirs(dirs):
 
 	# mimetype
     src = os.path.join(dirs['template_dir'], 'mimetype')
-    dst = os.path.join(dirs['gen_dir'], 'mimetype')
-    shutil.copyfile(src, dst)
+    output.copy(src, 'mimetype')
 
 	# META-INF
-    os.makedirs(os.path.join(dirs['gen_dir'], 'META-INF'))
+    if not os.path.exists(os.path.join(dirs['gen_dir'], 'META-INF')):
+        os.makedirs(os.path.join(dirs['gen_dir'], 'META-INF'))
     src = os.path.join(dirs['template_dir'], 'container.xml')
-    dst = os.path.join(dirs['gen_dir'], 'META-INF', 'container.xml')
-    shutil.copyfile(src, dst)
+    output.copy(src, 'META-INF/container.xml')
+
+    staged = stageFiles([(image_sources.get(src_path, src_path), dst_path)
+                         for src_path, dst_path in staged_files])
+    output.bytes_written += staged['bytes_moved'] # linked and cloned files write no data
+    msg("assets: %(linked)d linked, %(cloned)d cloned, %(copied)d copied (%(bytes_moved)d bytes moved), %(unchanged)d unchanged" % staged)
+    return staged
+
+# The cooked book is written through an output: DirOutput writes the
+# <book>_cooked folder which createArchive then zips, ZipOutput (--stream)
+# writes straight into the .epub (or into memory) with no folder at all.
+# Paths are relative to the root of the epub, eg. 'OEBPS/toc.ncx'.
+class DirOutput(object):
+    def __init__(self, root):
+        self.root = root
+        self.bytes_written = 0
+
+    def write(self, path, text):
+        text = text.encode('utf-8')
+        with open(join(self.root, *path.split('/')), 'wb') as f:
+            f.write(text)
+        self.bytes_written += len(text)
+
+    def copy(self, src, path):
+        shutil.copyfile(src, join(self.root, *path.split('/')))
+        self.bytes_written += os.path.getsize(src)
+
+    def listdir(self, path):
+        return os.listdir(join(self.root, *path.split('/')))
+
+    def close(self):
+        pass
+
+class ZipOutput(object):
+    def __init__(self, epub_file):
+        # epub_file is a path or a file object such as io.BytesIO
+        self.zip = zipfile.ZipFile(epub_file, 'w')
+        self.names = []
+        self.left_out = [] # files in the raw folders which aren't part of the book
+        self.bytes_written = 0
+        # mimetype must be the first entry, and not compressed
+        self.copy(os.path.join(dirs['template_dir'], 'mimetype'), 'mimetype', zipfile.ZIP_STORED)
+
+    def write(self, path, text):
+        text = text.encode('utf-8')
+        writeZipText(self.zip, path, text)
+        self.names.append(path)
+        self.bytes_written += len(text)
+
+    def copy(self, src, path, compress_type = zipfile.ZIP_DEFLATED):
+        if isBinaryAsset(path):
+            writeAsset(self.zip, src, path)
+        else:
+            writeZipFile(self.zip, src, path, compress_type)
+        self.names.append(path)
+        self.bytes_written += os.path.getsize(src)
+
+    def copyTree(self, src, path, sources={}, extensions=None):
+        # sources maps files to the files to copy instead, eg. optimised images,
+        # with extensions only files with one of them go into the epub
+        for name in sorted(os.listdir(src)):
+            if name == 'Thumbs.db': # not part of the book
+                continue
+            if os.path.isdir(join(src, name)):
+                self.copyTree(join(src, name), path+'/'+name, sources, extensions)
+            elif extensions is not None and os.path.splitext(name)[1].lower() not in extensions:
+                self.left_out.append(path+'/'+name)
+            else:
+                self.copy(sources.get(join(src, name), join(src, name)), path+'/'+name)
+
+    def listdir(self, path):
+        # with the files copyTree left out, so augmentImages warns about them
+        # as it does for the cooked folder
+        return [name[len(path)+1:] for name in self.names + self.left_out
+                if name.startswith(path+'/') and '/' not in name[len(path)+1:]]
+
+    def close(self):
+        self.zip.close()
+        saveAssetIndex()
+
+output = None # the DirOutput or ZipOutput of the current cook
+
+def checkRawImages(dirs):
+    if not os.path.exists(dirs['raw_images']):
+        # create ..._raw and ..._raw/images if they don't exist
+        os.makedirs(dirs['raw_images'])
+        src = os.path.join(dirs['demo_raw'], 'images', 'cover_image.jpg')
+        #src = 'demo_raw/images/cover_image.jpg'
+        shutil.copyfile(src, dirs['raw_images']+'/cover_image.jpg')
+
+def streamAssets(dirs, image_sources={}):
+    # --stream: the same files prepareDirs copies, written straight into the epub
+    checkRawImages(dirs)
+    output.copy(os.path.join(dirs['template_dir'], 'container.xml'), 'META-INF/container.xml')
+    output.copyTree(dirs['raw_images'], 'OEBPS/images', image_sources, image_media_types) # as augmentImages lists them
+    output.copy(os.path.join(dirs['template_dir'], 'epubchef_logo.jpg'), 'OEBPS/images/epubchef_logo.jpg')
+    output.copyTree(dirs['fonts'], 'OEBPS/fonts')
+    output.copyTree(dirs['css'], 'OEBPS/css')
+
+def syncTree(src, dst, keep=['epubchef_logo.jpg'], staged_files=None):
+    # like shutil.copytree, but into an existing directory: new and changed
+    # files are copied, files unchanged since the last copy (same size and
+    # modification time) are left alone and files no longer in src are removed.
+    # With a staged_files list the files to copy are added to it, for stageFiles.
+    if not os.path.exists(dst):
+        os.makedirs(dst)
+    src_names = os.listdir(src)
+    for name in os.listdir(dst):
+        if name not in src_names and name not in keep:
+            if os.path.isdir(join(dst, name)):
+                shutil.rmtree(join(dst, name))
+            else:
+                os.remove(join(dst, name))
+    for name in src_names:
+        src_path = join(src, name)
+        dst_path = join(dst, name)
+        if os.path.isdir(src_path):
+            syncTree(src_path, dst_path, keep, staged_files)
+            continue
+        if staged_files is not None:
+            staged_files.append((src_path, dst_path))
+            continue
+        if os.path.isfile(dst_path):
+            src_stat = os.stat(src_path)
+            dst_stat = os.stat(dst_path)
+            if src_stat.st_size == dst_stat.st_size \
+               and int(src_stat.st_mtime) == int(dst_stat.st_mtime):
+                continue
+        shutil.copy2(src_path, dst_path)
+
+# Assets are staged in the cooked folder by the cheapest way the file system
+# allows: a hard link (nothing is copied, the cooked file is the raw file),
+# a reflink clone (copy on write, btrfs and xfs) or a copy in a thread pool.
+# stage_links lists the ways to try, "--copy-assets" only copies.
+stage_links = ['link', 'clone']
+stage_threads = 8
+FICLONE = 0x40049409 # linux ioctl, clone a file's extents
+
+def cloneFile(src_path, dst_path):
+    import fcntl
+    with open(src_path, 'rb') as src_file:
+        with open(dst_path, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src_path, dst_path)
+
+def stageFile(src_path, dst_path, ways, stats, stats_lock):
+    src_stat = os.stat(src_path)
+    if os.path.isfile(dst_path):
+        dst_stat = os.stat(dst_path)
+        if src_stat.st_size == dst_stat.st_size \
+           and int(src_stat.st_mtime) == int(dst_stat.st_mtime):
+            with stats_lock:
+                stats['unchanged'] +=1
+            return
+        # never write through an old link into the raw file
+        os.remove(dst_path)
+    with stats_lock: # other threads drop ways that fail
+        ways_to_try = list(ways)
+    for way in ways_to_try:
+        try:
+            if way == 'link':
+                os.link(src_path, dst_path)
+                counted = 'linked'
+            else:
+                cloneFile(src_path, dst_path)
+                counted = 'cloned'
+            break
+        except (OSError, ImportError):
+            # eg. another device, or a file system without links or clones,
+            # don't try this way for the rest of the files
+            with stats_lock:
+                if way in ways:
+                    ways.remove(way)
+            if os.path.exists(dst_path):
+                os.remove(dst_path)
+    else:
+        shutil.copy2(src_path, dst_path)
+        counted = 'copied'
+    with stats_lock:
+        stats[counted] +=1
+        if counted == 'copied':
+            stats['bytes_moved'] += src_stat.st_size
+
+def stageFiles(staged_files):
+    # link, clone or copy (src, dst) pairs, returns how many went each way
+    stats = {'linked': 0, 'cloned': 0, 'copied': 0, 'unchanged': 0, 'bytes_moved': 0}
+    if not staged_files:
+        return stats
+    ways = [] if options.get('copy-assets') else list(stage_links)
+    stats_lock = threading.Lock()
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(min(stage_threads, len(staged_files))) as pool:
+        for result in [pool.submit(stageFile, src_path, dst_path, ways, stats, stats_lock)
+                       for src_path, dst_path in staged_files]:
+            result.result() # raise any error here
+    return stats
+
+def hashFile(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+def loadBuildManifest():
+    # hashes recorded by the last --incremental cook, if any
+    try:
+        with open(dirs['build_manifest'], 'r') as f:
+            return json.load(f)
+    except:
+        return {'chapters': {}, 'scenes': {}}
+
+def writeBuildManifest(build_manifest):
+    with open(dirs['build_manifest'] +'.'+ str(os.getpid()), 'w') as f:
+        json.dump(build_manifest, f, indent=1, sort_keys=True)
+    os.replace(dirs['build_manifest'] +'.'+ str(os.getpid()), dirs['build_manifest'])
+
+def chapterKey(_chapter, scene_hashes, rules_hash):
+    # everything a chapter's xhtml depends on: its recipe entry and position,
+    # the text of its scenes, the chapter template and cook.py itself (which
+    # holds the typography rules).
+    h = hashlib.sha1()
+    h.update(rules_hash.encode('utf-8'))
+    chapter_metadata = dict([(k, v) for k, v in _chapter.items() if k != 'scenes'])
+    h.update(json.dumps(chapter_metadata, sort_keys=True, default=str).encode('utf-8'))
+    h.update(str(recipe['auto_dropcaps']).encode('utf-8'))
+    for scene_hash in scene_hashes:
+        h.update(scene_hash.encode('utf-8'))
+    return h.hexdigest()
 
 def removeBlankLines(input):
     # TODO improve this hack to git rid of blank lines
@@ -268,17 +811,57 @@ def removeBlankLines(input):
             non_blank_lines.append(line)
     return non_blank_lines
 
-def processMarkdown(_line):
+def prepareMarkdown(_line):
     # markdown headers - add an extra level as the chapter header is <h1>
 
     if _line[0] == "#":
         _line = "#"+_line
 
     if _line[0] == "|":
-        msg("got a table: "+_line)
+        msg("got a table: %s", _line, level=DEBUG)
+    return _line
+
+def processMarkdown(_line):
+    import markdown
+    _line = prepareMarkdown(_line)
     _line = markdown.markdown(_line, output_format='xhtml5')
     return _line
 
+# one markdown instance is reused for every scene, setting one up
+# (with its extension pipeline) costs more than rendering a paragraph.
+scene_markdown = None
+para_marker = '<!--epubchef-para-->'
+# reference links are shared between paragraphs of one markdown document
+reference_re = re.compile(r'^\[[^\]]+\]:')
+
+def processMarkdownScene(_lines):
+    # render all the paragraphs of a scene in one markdown pass,
+    # paragraphs are separated by a marker so they can be split apart again.
+    global scene_markdown
+    if scene_markdown is None:
+        import markdown
+        scene_markdown = markdown.Markdown(output_format='xhtml5')
+    _lines = [prepareMarkdown(_line) for _line in _lines]
+
+    # raw html blocks and reference links can reach across paragraphs,
+    # only batch the scene when there are none.
+    batch = True
+    for _line in _lines:
+        if _line[0] == "<" or reference_re.match(_line):
+            batch = False
+    if batch and _lines:
+        scene_markdown.reset()
+        out = scene_markdown.convert(("\n\n"+para_marker+"\n\n").join(_lines))
+        rendered = [part.strip() for part in out.split(para_marker)]
+        if len(rendered) == len(_lines):
+            return rendered
+
+    rendered = []
+    for _line in _lines:
+        scene_markdown.reset()
+        rendered.append(scene_markdown.convert(_line))
+    return rendered
+
 def groupMarkdown(_n, lines):
     # some markdown such as lists and tables use more than one line from the input file. Note that the counter n will be adjusted by this function.
     # Simple lists
@@ -313,30 +896,46 @@ def groupMarkdown(_n, lines):
         # #print("whole table:", line)
     return _n, line
 
-def formatScene(in_file, scene_count, auto_dropcaps):
+def formatScene(in_file, scene_count, auto_dropcaps, batch_markdown=True, lazy=False):
+    # batch_markdown renders the whole scene with processMarkdownScene,
+    # otherwise each paragraph goes through processMarkdown on its own.
+    # lazy makes the scene's paras a generator, each paragraph is only built
+    # as the chapter template reaches it and can be dropped straight after.
     # replace characters we don't like
-    lines = [line.strip() for line in in_file]
-
-    style = next_para_style = None
-    all_paras = {}
-    paras = []
-    non_blank_lines = removeBlankLines(lines)
+    non_blank_lines = removeBlankLines(line.strip() for line in in_file)
 
-    need_to_clear = False
-    para_count = 0
+    # group lines into paragraphs (lists use more than one line)
+    grouped_lines = []
     n = 0
     while n < len(non_blank_lines):
         line = non_blank_lines[n]
-        para_class = setParaClass(para_count, scene_count=0)
-        para = {}
-        textblock = []
-        text_class = False # default
 
         line = preMarkdownTextClean(line)
 
         # process any markdown in the text
         n, line = groupMarkdown(n, non_blank_lines)
-        line = processMarkdown(line)
+        grouped_lines.append(line)
+
+        n+=1 # go to next line
+
+    if batch_markdown:
+        rendered_lines = processMarkdownScene(grouped_lines)
+    else:
+        rendered_lines = [processMarkdown(line) for line in grouped_lines]
+    del grouped_lines
+
+    paras = sceneParagraphs(rendered_lines, scene_count, auto_dropcaps)
+    if not lazy:
+        paras = list(paras)
+    _scene = dict(paras = paras)
+    return _scene
+
+def sceneParagraphs(rendered_lines, scene_count, auto_dropcaps):
+    # the structured paragraphs of a scene, from its markdown output
+    para_count = 0
+    for line in rendered_lines:
+        para_class = setParaClass(para_count, scene_count=0)
+        text_class = False # default
 
         line = postMarkdownTextClean(line)
 
@@ -359,49 +958,36 @@ def formatScene(in_file, scene_count, auto_dropcaps):
                 line = new + line
 
         # text_class and words
-        std_text_block = block(para, para_class, text_class, line)
-        textblock.append(std_text_block)
         para_count +=1
+        yield Paragraph(line, para_class, text_class)
 
-        para['textblock'] = textblock
-        paras.append(para)
-        all_paras['paras'] = paras
-
-        n+=1 # go to next line
-
-    prepared_scene = generateJson(all_paras)
-
-    _scene = dict(paras = paras)
-    return _scene
+def renderPage(_recipe, page_name):
+    # render a page (non-chapter page) to a string
+    return renderTemplate(page_name+'.xhtml', _recipe)
 
 def genPage(_recipe, page_name):
     # generate a page (non-chapter page)
     if page_name in ['table_of_contents','title_page']:
-        out_dir = 'content'
+        out_dir = 'OEBPS/content/'
     else:
-        out_dir = 'oebps'
+        out_dir = 'OEBPS/'
 
-    f = codecs.open(os.path.join(dirs[out_dir], page_name+".xhtml"), 'w', 'utf-8')
-    out = renderer.render_path(os.path.join(dirs['template_dir'],
-	    page_name+'.xhtml'), _recipe)
-    f.write(out)
-    f.close()
+    out = renderPage(_recipe, page_name)
+    output.write(out_dir+page_name+".xhtml", out)
 
 def genPackageOpf(_recipe):
     # generate package.opf file
-    f = codecs.open(os.path.join(dirs['oebps'],'package.opf'), 'w', 'utf-8')
-    out = renderer.render_path(os.path.join(dirs['template_dir'], 'packageopf.xhtml'), _recipe)
-    f.write(out)
-    f.close()
+    out = renderTemplate('packageopf.xhtml', _recipe)
+    output.write('OEBPS/package.opf', out)
 
 def genTocNcx(_recipe):
     # generate toc.ncx
-    f = codecs.open(os.path.join(dirs['oebps'],'toc.ncx'), 'w', 'utf-8')
-    out = renderer.render_path(os.path.join(dirs['template_dir'], 'tocncx.xhtml'), _recipe)
-    f.write(out)
-    f.close()
+    out = renderTemplate('tocncx.xhtml', _recipe)
+    output.write('OEBPS/toc.ncx', out)
 
 def genChapters(_recipe, front_matter_count, scenes_dict):
+    # number every chapter and part first, chapters don't depend on each
+    # other after that so they can be cooked in parallel (--jobs).
     chapter_nbr = 0
     part_nbr = 0
     for chapter in _recipe['chapters']:
@@ -417,35 +1003,235 @@ def genChapters(_recipe, front_matter_count, scenes_dict):
         else:
             chapter['playorder'] = str(next_playorder)
 
-        scene_nbr = 0
-        chapter = genChapter(chapter, scenes_dict[chapter['code']])
+    chapter_scenes = [(chapter, scenes_dict[chapter['code']]) for chapter in _recipe['chapters']]
+    build_manifest = None
+    if incremental:
+        chapter_scenes, build_manifest = changedChapters(chapter_scenes)
+    if jobs > 1 and len(chapter_scenes) > 1:
+        flushLog() # don't let worker processes inherit unwritten log lines
+        loadTemplate(join(dirs['template_dir'], 'chapter.xhtml')) # parse once, for every worker
+        pool = multiprocessing.Pool(min(jobs, len(chapter_scenes)),
+                                    initializer = initChapterWorker, initargs = (bookSettings(), _recipe))
+        try:
+            # workers get copies of the chapters, so use the ones they send back
+            cooked_chapters = {}
+            for chapter, out, chapter_stats in pool.starmap(renderChapter, chapter_scenes):
+                writeChapter(chapter, out)
+                stage_report['chapters'].append(chapter_stats)
+                cooked_chapters[chapter['nbr_fmt']] = chapter
+            _recipe['chapters'] = [cooked_chapters.get(chapter['nbr_fmt'], chapter)
+                                   for chapter in _recipe['chapters']]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for chapter, scenes in chapter_scenes:
+            chapter = genChapter(chapter, scenes)
 
+    # only now every chapter in the manifest has been written, a cook which
+    # fails before this leaves the last manifest, so those chapters are cooked again
+    if build_manifest is not None:
+        writeBuildManifest(build_manifest)
     msg("chapter count: "+ str(chapter_nbr))
-    return _recipe, next_playorder
+    return _recipe, next_playorder, len(chapter_scenes)
+
+def changedChapters(chapter_scenes):
+    # for --incremental, leave out chapters whose inputs are the same as in
+    # the build manifest from the last cook. Returns the chapters to cook and
+    # the new manifest, for genChapters to write once they are cooked.
+    old_manifest = loadBuildManifest()
+    rules_hash = hashlib.sha1((hashFile(os.path.realpath(__file__))
+        + hashFile(join(dirs['template_dir'], 'chapter.xhtml'))).encode('utf-8')).hexdigest()
+    build_manifest = {'chapters': {}, 'scenes': {}}
+    changed = []
+    hashed = 0
+    for chapter, scenes in chapter_scenes:
+        scene_hashes = []
+        for scene_name in scenes:
+            # only scenes whose size or modification time changed are hashed again
+            size, mtime = sceneStamp(scene_name)
+            known = old_manifest['scenes'].get(scene_name)
+            if isinstance(known, list) and known[:2] == [size, mtime]:
+                scene_hash = known[2]
+            else:
+                scene_hash = hashFile(join(dirs['raw_book'], scene_name+'.txt'))
+                hashed +=1
+            build_manifest['scenes'][scene_name] = [size, mtime, scene_hash]
+            scene_hashes.append(scene_hash)
+        chapter_file = 'chap'+chapter['nbr_fmt']+'.xhtml'
+        key = chapterKey(chapter, scene_hashes, rules_hash)
+        build_manifest['chapters'][chapter_file] = key
+        if old_manifest['chapters'].get(chapter_file) == key \
+           and os.path.isfile(join(dirs['content'], chapter_file)):
+            continue
+        changed.append((chapter, scenes))
+
+    # chapters which are no longer in the recipe
+    for chapter_file in os.listdir(dirs['content']):
+        if chapter_file.startswith('chap') and chapter_file not in build_manifest['chapters']:
+            os.remove(join(dirs['content'], chapter_file))
+
+    msg("chapters changed since the last cook: "+ str(len(changed)) + " of " + str(len(chapter_scenes))
+        + " (" + str(hashed) + " scenes hashed)")
+    return changed, build_manifest
+
+def initChapterWorker(settings, _recipe):
+    # chapter worker processes need the book settings and the recipe for prepareScene
+    global recipe
+    setupBook(*settings)
+    recipe = _recipe
 
 def genChapter(_chapter, scenes):
     # generate the book using templates and the recipe
-    _chapter['scenes'] = []
+    _chapter, out, chapter_stats = renderChapter(_chapter, scenes)
+    writeChapter(_chapter, out)
+    stage_report['chapters'].append(chapter_stats)
+    return _chapter
+
+def chapterScenes(scenes, counts, lazy):
+    # the scenes of a chapter, in order with dividers between them. Scenes are
+    # read as the chapter template reaches them, lazy scenes count their
+    # paragraphs as they go by.
     scene_count = 0 # counts the position of the scene in this chapter
                       # for dividers and drop_caps
     for scene_name in scenes:
         #add divider between scenes
         if scene_count > 0:
-            _chapter['scenes'].append(dict(divider = True))
+            yield dict(divider = True)
 	# turn the raw text into structured text
-        prepared_scene = prepareScene(scene_name, scene_count)
-        _chapter['scenes'].append(prepared_scene)
+        prepared_scene = prepareScene(scene_name, scene_count, lazy)
+        if isinstance(prepared_scene['paras'], list):
+            counts['paragraphs'] += len(prepared_scene['paras'])
+        else:
+            prepared_scene = dict(paras = countParagraphs(prepared_scene['paras'], counts))
+        yield prepared_scene
         scene_count+=1
-    # write the chapter
-    f = codecs.open(os.path.join(dirs['content'], 'chap'+_chapter['nbr_fmt']+'.xhtml'), 'w', 'utf-8')
-	#f = codecs.open(os.path.join(dirs['content'], 'chap'+_chapter['nbr']+'.xhtml'), 'w', 'utf-8')
-    out = renderer.render_path(os.path.join(dirs['template_dir'], 'chapter.xhtml'), _chapter)
-    #remove blank lines
-    out =  "".join([s for s in out.strip().splitlines(True) if s.strip()])
-    f.write(out)
-    f.close()
 
-    return _chapter
+def countParagraphs(paras, counts):
+    for para in paras:
+        counts['paragraphs'] += 1
+        yield para
+
+def renderChapter(_chapter, scenes):
+    # the chapter, its xhtml and its timings, worker processes send them back to be written.
+    # Scenes stream through directChapterXhtml and are dropped once the chapter is
+    # rendered, so memory doesn't grow with the size of the book. A custom
+    # chapter.xhtml may loop over the scenes more than once (or test them with
+    # {{^scenes}}), so it gets lists. When debugging they are kept (for the trace
+    # and the augmented recipe).
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    rss_started = memoryStarted(False) # chapters are part of the genChapters stage's traced peak
+    counts = {'paragraphs': 0}
+    direct = directChapters() and isDirectChapter(_chapter)
+    if trace_dir or not direct:
+        _chapter['scenes'] = list(chapterScenes(scenes, counts, False))
+        if trace_dir:
+            traceScenes('chap'+_chapter['nbr_fmt'], _chapter['scenes'])
+    else:
+        _chapter['scenes'] = chapterScenes(scenes, counts, True)
+
+    if direct:
+        out = directChapterXhtml(_chapter)
+    else:
+        out = templateChapterXhtml(_chapter)
+    if not trace_dir:
+        del _chapter['scenes']
+    chapter_stats = {'chapter': 'chap'+_chapter['nbr_fmt'],
+                     'wall_ms': round((time.perf_counter() - started) * 1000, 2),
+                     'cpu_ms': round((time.process_time() - cpu_started) * 1000, 2)}
+    chapter_stats.update(memoryUsed(rss_started, False))
+    chapter_stats.update({'scenes': len(scenes),
+                          'paragraphs': counts['paragraphs'],
+                          'characters': len(out)})
+    return _chapter, out, chapter_stats
+
+def templateChapterXhtml(_chapter):
+    # render chapter.xhtml, then remove its blank lines
+    out = renderTemplate('chapter.xhtml', _chapter)
+    #remove blank lines
+    return "".join([s for s in out.strip().splitlines(True) if s.strip()])
+
+# directChapterXhtml writes what the stock chapter.xhtml renders to, without
+# pystache or the blank line pass. An edited chapter.xhtml is rendered as before.
+stock_chapter_sha1 = '120fe4f8664098c44b06b9723453ff16e60711b2'
+chapter_template_stock = {} # path: (modification time, is it the stock template)
+# characters str.splitlines breaks lines at
+line_break_re = re.compile('[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+
+def directChapters():
+    # True when chapter.xhtml is the stock template
+    template_path = join(dirs['template_dir'], 'chapter.xhtml')
+    mtime = os.stat(template_path).st_mtime_ns
+    if chapter_template_stock.get(template_path, (None,))[0] != mtime:
+        chapter_template_stock[template_path] = (mtime, hashFile(template_path) == stock_chapter_sha1)
+    return chapter_template_stock[template_path][1]
+
+def isDirectChapter(_chapter):
+    # directChapterXhtml only knows text values, anything else goes through the template
+    for key in ['starts_part', 'photo', 'intro']: # sections, skipped when empty
+        if _chapter.get(key) and not isinstance(_chapter[key], str):
+            return False
+    for key in ['title', 'id', 'nbr', 'name']: # always written when there
+        if key in _chapter and not isinstance(_chapter[key], str):
+            return False
+    return True
+
+def keepLine(line):
+    # line with the blank lines templateChapterXhtml would remove removed
+    if line_break_re.search(line):
+        return "".join([s for s in line.splitlines(True) if s.strip()])
+    if line.strip():
+        return line
+    return ''
+
+def directChapterXhtml(_chapter):
+    # the same xhtml as templateChapterXhtml, line by line from the chapter
+    escape = html.escape
+    out = ['<?xml version="1.0" encoding="UTF-8"?><html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n'
+           '<head>\n',
+           keepLine('<title>'+ escape(_chapter.get('title') or '') +'</title><link rel="stylesheet" href="../css/epub-stylesheet.css" type="text/css"/>\n'),
+           '<meta charset="utf-8"/>\n'
+           '</head>\n'
+           '<body>\n']
+    if _chapter.get('starts_part'):
+        out.append('<div class="part_start">\n')
+        out.append(keepLine('  <h1 id="part">'+ escape(_chapter['starts_part']) +'</h1>\n'))
+        out.append('</div>\n')
+    out.append('<section class="body-rw Chapter-rw" epub:type="bodymatter chapter">\n'
+               '<header>\n')
+    out.append(keepLine('  <div id="'+ escape(_chapter.get('id') or '') +'">\n'))
+    out.append(keepLine('    <h1>Chapter '+ escape(_chapter.get('nbr') or '') +'<br/>'+ (_chapter.get('name') or '') +'</h1>\n'))
+    if _chapter.get('photo'):
+        photo = escape(_chapter['photo'])
+        out.append(keepLine('    <p class="centered"><img class="displayed" src="../images/'+ photo
+                            +'" height="100" alt="'+ photo +'" /></p><br/>\n'))
+    out.append('  </div>\n'
+               '</header>\n')
+    if _chapter.get('intro'):
+        out.append(keepLine('<p class="chapterIntro">'+ _chapter['intro'] +'</p>\n'))
+    out.append('<p><br/></p>\n')
+    for scene in _chapter.get('scenes') or []:
+        if scene.get('divider'):
+            out.append('    <p class="centered">~~~~~~~~~~~~~~</p>\n')
+        for para in scene.get('paras') or []:
+            # paragraphs from markdown have their tags, so no needs_para_tag here
+            text_class = para.text_class
+            if text_class:
+                out.append(keepLine('          <span class="'+ escape(text_class) +'">\n'))
+            words = para.words
+            if line_break_re.search(words):
+                out.append(keepLine('            '+ words +'\n'))
+            elif words.strip():
+                out.append('            '+ words +'\n')
+            if text_class:
+                out.append('          </span>\n')
+    out.append('</section></body></html>')
+    return "".join(out)
+
+def writeChapter(_chapter, out):
+    # write the chapter
+    output.write('OEBPS/content/chap'+_chapter['nbr_fmt']+'.xhtml', out)
 
 def preMarkdownTextClean(line):
     # escape odd characters
@@ -453,70 +1239,81 @@ def preMarkdownTextClean(line):
 
     return line
 
-def postMarkdownTextClean(line):
-	# three dots ... to an elipsis
-    line = line.replace('...',"&#8230;")
-
-    line = line.replace("&rsquo;","&#8217;") # right single quote
-    line = line.replace("&lsquo;","&#8216;") # left single quote
-    line = line.replace("&pound;","&#163;") # pound sign
-
-    # left double quotes #########################
-    # replace straight double quote following a space with left smart quote
-    line = line.replace(' "'," &#8220;")
-
-    # replace straight double quote at start of a line with a left smart quote
-    if line[0:4] == '<p>"':
-        line = line.replace('"',"&#8220;", 1)
-
-    # undo smart quotes on xhtml links
-    line = line.replace('<a &#8220;','<a "')
-
-    # right double quotes #######################
-    # replace straight double quote preceding a space with a right smart quote
-    line = line.replace('" ',"&#8221; ")
-
-    # replace straight double quote following a period with a right smart quote at end of paragraphs
-    line = line.replace('."',".&#8221;")
-
-    # replace straight double quote following a question mark with a right smart quote
-    line = line.replace('?"',"?&#8221;")
-
-    # replace straight double quote following a exclamation with a right smart quote
-    line = line.replace('!"',"!&#8221;")
-
-    # undo smart quotes on image xhtml links - part one
-    line = line.replace('.jpg&#8221;','.jpg"')
-    line = line.replace('.png&#8221;','.png"')
-    # undo smart quotes on image xhtml links - part two
-    line = line.replace('&#8221;/>','"/>')
-    line = line.replace('&#8221; />','" />')
-    # undo smart quotes on image xhtml links - part three
-    line = line.replace('&#8221; alt=','" alt=')
-    line = line.replace('&#8221; src=','" src=')
+# typography rules for postMarkdownTextClean, which applies them all in one
+# pass over each paragraph. Markup (anything in <...>) is left untouched.
+typography_entities = {
+    '&rsquo;' : '&#8217;', # right single quote
+    '&lsquo;' : '&#8216;', # left single quote
+    '&pound;' : '&#163;',  # pound sign
+    }
+typography_sequences = {
+    '...' : '&#8230;', # three dots ... to an elipsis
+    }
+# straight quote: (left smart quote, right smart quote, characters a right quote follows)
+# a quote following a space or starting a paragraph is a left quote, a quote
+# followed by a space or following one of the characters is a right quote.
+typography_quotes = {
+    '"' : ('&#8220;', '&#8221;', '.?!'),
+    "'" : ('&#8216;', '&#8217;', '.'),
+    }
+
+# tags and entities only need a look when they hold something a rule applies to,
+# the rest are copied along with the text around them. Every alternative
+# starts with a literal character so the regex engine can skip plain text quickly.
+typography_tokens = ([r'<[^>]*["\'&.][^>]*>'] # tags
+    + [re.escape(k) for k in typography_entities] + ['&amp;', r'&(?![#a-zA-Z0-9]+?;)']
+    + [re.escape(k) for k in typography_sequences]
+    + [re.escape(k) for k in typography_quotes])
+typography_re = re.compile('|'.join(typography_tokens))
+# stopping at every space is slow, so double spaces are only looked for in
+# the (few) paragraphs which have them.
+typography_spaces_re = re.compile('|'.join(typography_tokens + ['   *']))
+bare_ampersand_re = re.compile(r'&(?![#a-zA-Z0-9]+?;)')
 
-    # left single quotes ##########################
-    # replace straight single quote following a space with left smart quote
-    line = line.replace(" '"," &#8216;")
-
-    # replace straight single quote at start of a line with a left smart quote
-    if line[0:4] == "<p>'":
-        line = line.replace("'","&#8216;", 1)
-
-    # right single quotes ########################
-    # replace straight single quote preceding a space with a right smart quote
-    line = line.replace("' ","&#8217; ")
-
-    # replace straight single quote following a period with a right smart quote
-    line = line.replace(".'",".&#8217;")
-
-    # ampersands
-    line = re.sub(r'&(?![#a-zA-Z0-9]+?;)', "&#38;", line)
-    line = line.replace(" &amp; "," &#38; ")
-
-    # double spaces to single
-    line = line.replace("  "," ")
-    return line
+def postMarkdownTextClean(line):
+    # smart quotes, elipses, entities, ampersands and double spaces
+    # in one pass, see the typography_ tables above.
+    out = []
+    prev = '' # last character written
+    pos = 0
+    amp_space = -1 # position of a space already used by a " &amp; "
+    if '  ' in line:
+        tokens = typography_spaces_re.finditer(line)
+    else:
+        tokens = typography_re.finditer(line)
+    for match in tokens:
+        start, end = match.span()
+        if start > pos:
+            out.append(line[pos:start])
+            prev = line[start-1]
+        token = match.group()
+        first = token[0]
+        if first in typography_quotes:
+            left, right, right_after = typography_quotes[token]
+            if prev == ' ' or (start == 3 and line[0:3] == '<p>'):
+                token = left
+            elif line[end:end+1] == ' ' or (prev and prev in right_after):
+                token = right
+        elif first == '<':
+            if '&' in token:
+                token = bare_ampersand_re.sub("&#38;", token)
+        elif token in typography_sequences:
+            token = typography_sequences[token]
+        elif first == ' ': # double spaces to single
+            token = ' ' * ((len(token)+1) // 2)
+        elif token == '&amp;':
+            if prev == ' ' and start-1 != amp_space and line[end:end+1] == ' ':
+                token = "&#38;"
+                amp_space = end
+        else: # entity or a bare ampersand
+            token = typography_entities.get(token, "&#38;")
+        out.append(token)
+        prev = token[-1]
+        pos = end
+    if not pos:
+        return line
+    out.append(line[pos:])
+    return ''.join(out)
 
 def setParaClass(para_count, scene_count):
     para_class = False
@@ -537,35 +1334,86 @@ def dropCap(line):
     text_class = 'dropcap'
     return drop_letter, line, text_class
 
-def block(para, para_class, text_class, words):
-    if para_class:
-        para['class'] = para_class
-    the_block = {'words' : words}
-    if text_class:
-        the_block['text_class'] = text_class
-    return the_block
+class Paragraph(object):
+    # one paragraph of a scene, to templates it looks like the dictionary
+    # {'class': para_class, 'textblock': [{'words': words, 'text_class': text_class}]}
+    # class and text_class are False when not set. Templates find every name
+    # they look for on the paragraph itself, which keeps rendering quick.
+    __slots__ = ('words', 'class', 'text_class')
+    needs_para_tag = False # markdown already wrapped the words in a tag
+
+    def __init__(self, words, para_class=False, text_class=False):
+        self.words = words
+        setattr(self, 'class', para_class) # class is a python keyword
+        self.text_class = text_class
+
+    @property
+    def para_class(self):
+        return getattr(self, 'class')
+
+    @property
+    def textblock(self):
+        return (self,)
+
+    def asDict(self):
+        # the dictionary, for json and for comparing with the old structure
+        para = {}
+        if self.para_class:
+            para['class'] = self.para_class
+        the_block = {'words' : self.words}
+        if self.text_class:
+            the_block['text_class'] = self.text_class
+        para['textblock'] = [the_block]
+        return para
+
+    def __eq__(self, other):
+        return isinstance(other, Paragraph) and self.asDict() == other.asDict()
+
+    def __repr__(self):
+        return repr(self.asDict())
 
 def generateJson(all_paras):
     # use a template to generate the scene in json format
-    prepared_scene = renderer.render_path(os.path.join(template_dir, 'scene.mustache'), all_paras)
-     # write the json file, just for humans
-    if arg2 == 'debug':
-        f = open(os.path.join(dirs['tmp'],'tmp_all_paras.json'), 'a')
-        f.write("\n")
-        json.dump(all_paras, f)
-        f.close()
-
-        f = open(os.path.join(dirs['tmp'],'tmp_paras.json'), 'a')
-        f.write("\n")
-        json.dump(prepared_scene, f)
-        f.close()
+    prepared_scene = renderTemplate('scene.mustache', all_paras)
     return prepared_scene
 
-def prepareScene(scene_name, scene_count):
+def traceScenes(trace_name, scenes):
+    # write the structured paragraphs of a chapter (or page), and their
+    # scene.mustache rendering, to one json file, just for humans.
+    # Only done when there is somewhere to write it (debug).
+    if not trace_dir:
+        return
+    trace = []
+    for scene in scenes:
+        if 'paras' in scene: # not a divider
+            trace.append({'paras': [para.asDict() for para in scene['paras']],
+                          'scene_json': generateJson(scene)})
+    f = codecs.open(os.path.join(trace_dir, trace_name+'.json'), 'w', 'utf-8')
+    json.dump({'name': trace_name, 'scenes': trace}, f, indent=1)
+    f.close()
+
+# formatted scenes kept between cooks by "watch", keyed by scene, position
+# and drop caps setting, with the file's size and modification time.
+scene_cache = {}
+keep_scenes = False
+
+def prepareScene(scene_name, scene_count, lazy=False):
+    # lazy is passed on to formatScene, but scenes kept for watch mode are built in full
+    scene_path = join(dirs['raw_book'], scene_name+'.txt')
+    if keep_scenes:
+        cache_key = (scene_path, scene_count, recipe['auto_dropcaps'])
+        file_stamp = sceneStamp(scene_name)
+        if cache_key in scene_cache and scene_cache[cache_key][0] == file_stamp:
+            return scene_cache[cache_key][1]
+
     # open raw scene file
-    in_file = codecs.open(join(dirs['raw_book'], scene_name+'.txt'), 'r', 'utf-8')
-    prepared_scene = formatScene(in_file, scene_count, recipe['auto_dropcaps'])
+    in_file = codecs.open(scene_path, 'r', 'utf-8')
+    prepared_scene = formatScene(in_file, scene_count, recipe['auto_dropcaps'],
+                                 lazy = lazy and not keep_scenes)
     in_file.close()
+
+    if keep_scenes:
+        scene_cache[cache_key] = (file_stamp, prepared_scene)
     return prepared_scene
 
 def checkFrontBackMatter(_recipe):
@@ -607,11 +1455,11 @@ def addPOSData(pos_data_loc):
     # it must be YAML file similar to the book recipe file. It will be appended to the recipe
     # TODO: augment to read from a URL or as input to this job
     # local file read works fine for demonstrations.
+    import yaml
     try:
-        pos_data_loc = os.path.join(file_name+'_raw', file_name+'_pos_data.txt')
         msg('Opening Point Of Sale data for: '+ pos_data_loc)
         with open(pos_data_loc, 'r') as f:
-            point_of_sale = yaml.load(f)
+            point_of_sale = yaml.safe_load(f)
     except: # create a new recipe from a template
         msg('No Point of Sale data this time.')
         point_of_sale = None
@@ -668,7 +1516,7 @@ def augmentParts(_recipe):
     # add chapters to the parts section of the recipe, create parts if not existing.
     if 'parts' in _recipe:
         for part in _recipe['parts']:
-            msg('PART: '+ str(part))
+            msg('PART: %s', part, level=DEBUG)
             part['chp'] = []
             include_chapter_in_part = False
             for c in _recipe['chapters']:
@@ -684,13 +1532,13 @@ def augmentParts(_recipe):
                     #include_chapter_in_part = True
                     pass
                 if include_chapter_in_part:
-                    msg('  CHAPTER:'+ c['code'])
+                    msg('  CHAPTER:%s', c['code'], level=DEBUG)
                     chapter_metadata = getChapterMetadata(c)
                     part['chp'].append(chapter_metadata)
             try:
                 part['starting_chapter'] = starting_chapter
             except:
-                msg('***ERROR, must define at least one valid starts_part in a recipe***')
+                msg('***ERROR, must define at least one valid starts_part in a recipe***', level=ERROR)
                 raise SystemExit
             part['chap_toc_style'] = 'toc_chapter_with_parts'
     else: # user entered no parts, so make 1 default part.
@@ -720,24 +1568,129 @@ def augmentBackMatter(_recipe, playorder):
 
     return _recipe
 
+# With optimise_images in the recipe, eg.
+#   optimise_images:
+#       max_width: 1600
+#       max_height: 2400
+#       quality: 80          # jpg quality
+#       strip_metadata: True # camera (exif) data, the colour profile is kept
+# raw images are shrunk to fit and compressed again, using Pillow when it is
+# installed (pip install Pillow). Each image is optimised once: the results are
+# kept in asset_cache/images/, named by the sha1 of the raw image and the settings.
+optimise_defaults = {'max_width': 1600, 'max_height': 2400, 'quality': 80, 'strip_metadata': True}
+optimise_formats = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.gif': 'GIF'}
+
+def optimiseImage(src_path, dst_path, settings):
+    # shrink and compress one image in a worker process, returns
+    # (src_path, raw bytes, optimised bytes, seconds)
+    from PIL import Image
+    started = time.time()
+    image_format = optimise_formats[os.path.splitext(src_path)[1].lower()]
+    tmp_path = dst_path + '.' + str(os.getpid())
+    with Image.open(src_path) as image:
+        if getattr(image, 'is_animated', False): # keep every frame of animated gifs
+            shutil.copyfile(src_path, tmp_path)
+        else:
+            resized = image.size[0] > settings['max_width'] or image.size[1] > settings['max_height']
+            image.thumbnail((settings['max_width'], settings['max_height']), Image.LANCZOS)
+            save_options = {'optimize': True}
+            if image.info.get('icc_profile'):
+                save_options['icc_profile'] = image.info['icc_profile']
+            if not settings['strip_metadata'] and image.info.get('exif'):
+                save_options['exif'] = image.info['exif']
+            if image_format == 'JPEG':
+                save_options['quality'] = settings['quality']
+                save_options['progressive'] = True
+            image.save(tmp_path, image_format, **save_options)
+            # an image that didn't need shrinking is kept if compressing made it bigger
+            if not resized and os.path.getsize(tmp_path) >= os.path.getsize(src_path):
+                shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+    return src_path, os.path.getsize(src_path), os.path.getsize(dst_path), time.time() - started
+
+def optimiseImages(dirs):
+    # optimise the raw images as the recipe asks, returns raw image path: optimised image path
+    if not recipe.get('optimise_images'):
+        return {}
+    try:
+        import PIL
+    except ImportError:
+        msg("WARNING: optimise_images needs Pillow (pip install Pillow), images are used as they are", level=WARNING)
+        return {}
+    settings = dict(optimise_defaults)
+    if isinstance(recipe['optimise_images'], dict):
+        settings.update(recipe['optimise_images'])
+    settings_hash = hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    if not os.path.exists(dirs['image_cache']):
+        os.makedirs(dirs['image_cache'])
+
+    checkRawImages(dirs)
+    image_sources = {}
+    to_optimise = []
+    for name in sorted(os.listdir(dirs['raw_images'])):
+        extension = os.path.splitext(name)[1].lower()
+        src_path = join(dirs['raw_images'], name)
+        if extension not in optimise_formats or not os.path.isfile(src_path):
+            continue
+        dst_path = join(dirs['image_cache'], indexedHash(src_path) +'_'+ settings_hash + extension)
+        image_sources[src_path] = dst_path
+        if not os.path.isfile(dst_path):
+            to_optimise.append((src_path, dst_path, settings))
+    saveAssetIndex() # the raw images' hashes
+
+    # --jobs sets the number of worker processes, otherwise one per cpu
+    processes = min(jobs if jobs > 1 else multiprocessing.cpu_count(), len(to_optimise))
+    if multiprocessing.current_process().daemon:
+        processes = 1 # eg. in a catalog worker, which can't start processes of its own
+    if processes > 1:
+        flushLog() # don't let worker processes inherit unwritten log lines
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.starmap(optimiseImage, to_optimise)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [optimiseImage(*image) for image in to_optimise]
+    for src_path, raw_bytes, optimised_bytes, seconds in results:
+        msg("image %s: %dKB to %dKB in %.0fms", os.path.basename(src_path), raw_bytes // 1024,
+            optimised_bytes // 1024, seconds * 1000, level=DEBUG)
+    msg("images optimised: %d, from the cache: %d" % (len(results), len(image_sources) - len(results)))
+    return image_sources
+
+# EPUB core media types of images, other files in the images folder are left out
+image_media_types = {
+    '.jpg' : 'image/jpeg',
+    '.jpeg' : 'image/jpeg',
+    '.png' : 'image/png',
+    '.gif' : 'image/gif',
+    '.svg' : 'image/svg+xml',
+    }
+
 def augmentImages(_recipe):
     # create an images section in 'recipe'
     _recipe['images'] = []
+    _recipe['cover_image'] = 'cover_image.jpg'
     images = _recipe['images']
     id = 0
     # TODO make bulletproof, deal with images in paras and alt words
-    all_images = os.listdir(dirs['images'])
+    all_images = sorted(output.listdir('OEBPS/images')) # the same order in every cook
     try:
         all_images.remove('Thumbs.db') # not an image
     except:
         pass
     for image in all_images:
+        image_name, extension = os.path.splitext(image)
+        if extension.lower() not in image_media_types:
+            msg("WARNING: not a jpg, png, gif or svg image, left out of the book: "+ image, level=WARNING)
+            continue
         id+=1
-        image_name = image[:-4] # trim suffix and dot
+        image_entry = {'image': image_name, 'file': image, 'id': 'img'+str(id),
+                       'media_type': image_media_types[extension.lower()]}
         if image_name == 'cover_image':
-            images.append({'image': image_name, 'id': 'img'+str(id), 'cover':True})
-        else:
-	        images.append({'image': image_name, 'id': 'img'+str(id)})
+            image_entry['cover'] = True
+            _recipe['cover_image'] = image
+        images.append(image_entry)
 
     return _recipe
 
@@ -747,7 +1700,7 @@ def augmentFonts():
     fonts = []
     id = 0
 
-    for font in os.listdir(dirs['fonts']):
+    for font in sorted(os.listdir(dirs['fonts'])):
         id+=1
         font_name = font.split(".")[0] # trim suffix and dot
         font_type = font.split(".")[1]
@@ -759,7 +1712,7 @@ def cleanChapterMetaData(_recipe):
     for chapter in _recipe['chapters']:
         if chapter['name'] is None:
             chapter['name'] = "chapter name missing from recipe"
-            msg("WARNING: chapter name missing from recipe - " + chapter['code'])
+            msg("WARNING: chapter name missing from recipe - " + chapter['code'], level=WARNING)
         new_text = postMarkdownTextClean(chapter['name'])
         chapter['name'] = new_text
     return _recipe
@@ -789,17 +1742,53 @@ def addContentFiles(_recipe):
 
     return content_files
 
+def plainData(data):
+    # a copy of the recipe (or part of it) with paragraphs as dictionaries
+    if isinstance(data, Paragraph):
+        return data.asDict()
+    if isinstance(data, dict):
+        return dict([(key, plainData(value)) for key, value in data.items()])
+    if isinstance(data, list):
+        return [plainData(item) for item in data]
+    return data
+
 def writeAugmentedRecipe(_recipe):
     # write recipe to a file merely for humans to look at should they wish
     if arg2 == 'debug':
         pp = pprint.PrettyPrinter(indent=2)
-        entire_structured_book = pprint.pformat(_recipe)
+        entire_structured_book = pprint.pformat(plainData(_recipe))
         f = codecs.open(join(dirs['tmp'], 'augmented_'+file_name+'_recipe.json'), 'w', 'utf-8')
         f.write(entire_structured_book)
         f.close()
 
+# the scene files of the raw book, found by getScenesDict with one os.scandir per cook:
+# scene name: (size, modification time), for changedChapters and prepareScene
+scene_stamps = {}
+
+def indexScene(scene_index, scene, scene_stat):
+    # raw book files must begin with an underscore and 3 digits identifying the chapter
+    chapter_id = scene[1:4] # extract chapter id
+    try:
+        int(chapter_id)
+    except ValueError:
+        msg('Not a scene:'+ scene, level=WARNING)
+        return
+    if chapter_id not in scene_index:
+        scene_index[chapter_id] = []
+    scene_index[chapter_id].append((scene, scene_stat.st_size, scene_stat.st_mtime_ns))
+
+def indexScenes(raw_scenes_dir):
+    # chapter id: [(scene name, size, modification time), ...] of the _*.txt files
+    scene_index = {}
+    with os.scandir(raw_scenes_dir) as entries:
+        entries = sorted([entry for entry in entries
+                          if entry.name.startswith('_') and entry.name.endswith('.txt')],
+                         key=lambda entry: entry.name)
+    for entry in entries:
+        indexScene(scene_index, entry.name[:-4], entry.stat())
+    return scene_index
+
 def getScenesDict(raw_scenes_dir):
-    checkForChapterFiles()
     # get ordered list of scenes per chapter from raw dir
     # each file must begin with a chapter id followed by an underscore
     # scenes will be put in alphabetical order by file name within the chapter.
@@ -808,43 +1797,34 @@ def getScenesDict(raw_scenes_dir):
     #  '_002': ['0010_scene2','0020_scene3'],
     # }  # the scene numbers are only for the alphabetical order and to allow adding
     #    # new scenes between existing ones without needing to rename everything.
-    # raw book files must begin with 3 digits identifying the chapter
-    os.chdir(raw_scenes_dir)
-    ingredients_list = sorted(glob.glob('./_*.txt'))
-    os.chdir('..')
-    # put list into a dict.
+    global scene_stamps
+    scene_index = indexScenes(raw_scenes_dir)
+    checkForChapterFiles(scene_index)
     scene_dict = {}
-    for scene in ingredients_list:
-        scene = scene[2:] # remove ".//" from front
-        scene = scene[:-4] # remove ".txt" from end
-        chapter_id = scene[1:4] # extract chapter id
-        try:
-            int_chapter_id = int(chapter_id)
-            isScene = True
-        except:
-            isScene = False
-            msg('Not a scene:'+ scene)
-        if isScene:
-            if chapter_id not in scene_dict:
-                scene_dict[chapter_id] = []
-
-            scene_dict[chapter_id].append(scene)
+    scene_stamps = {}
+    for chapter_id, scenes in scene_index.items():
+        scene_dict[chapter_id] = [scene for scene, size, mtime in scenes]
+        for scene, size, mtime in scenes:
+            scene_stamps[scene] = (size, mtime)
     return scene_dict
 
-def checkForChapterFiles():
+def checkForChapterFiles(scene_index):
     # ensure each chapter in the recipe has at least one file, if not
     # create empty file.
-    os.chdir(dirs['raw_book'])
-    ingredients_list = glob.glob('./_*.txt')
-    chapter_code_ingredients = []
-    for item in ingredients_list:
-        chapter_code_ingredients.append(item[3:6])
     for chapter in recipe['chapters']:
-        if chapter['code'] not in chapter_code_ingredients:
+        if chapter['code'] not in scene_index:
             msg('creating new empty chapter:'+ chapter['code'])
-            f = open('_'+chapter['code']+'_0010_.txt','w+')
+            scene_path = join(dirs['raw_book'], '_'+chapter['code']+'_0010_.txt')
+            f = open(scene_path,'w+')
             f.close()
-    os.chdir('..')
+            indexScene(scene_index, '_'+chapter['code']+'_0010_', os.stat(scene_path))
+
+def sceneStamp(scene_name):
+    # size and modification time of a scene file, from the scene index if it is there
+    if scene_name in scene_stamps:
+        return scene_stamps[scene_name]
+    scene_stat = os.stat(join(dirs['raw_book'], scene_name+'.txt'))
+    return (scene_stat.st_size, scene_stat.st_mtime_ns)
 
 def genFrontBackMatter(_recipe):
     # for each front/back matter page the recipe name refers to:
@@ -863,6 +1843,7 @@ def genFrontBackMatter(_recipe):
                 # try again (with empty file)
                 in_file = open(join(dirs['raw_book'], page['name']+'.txt'), 'r')
             formatted_txt = formatScene(in_file, 0, False)
+            traceScenes(page['name'], [formatted_txt])
             _recipe[page['name']] = formatted_txt
         genPage(_recipe, page['name'])
     return _recipe
@@ -882,19 +1863,251 @@ def manifest_items():
     #items.append('css/kindle-stylesheet.css')
     #items.append('cover_image.jpg')
     for item in recipe['images']:
-        items.append("images/"+item['image']+".jpg")
+        items.append("images/"+item['file'])
     for font in recipe['fonts']:
         items.append("fonts/"+font['name']+"."+font['type'])
     return items
 
+# "--deterministic" (also on when SOURCE_DATE_EPOCH is set, as reproducible-builds.org
+# suggest) cooks the same .epub, byte for byte, from the same inputs: every zip entry
+# gets the same timestamp (SOURCE_DATE_EPOCH, or 1980-01-01) and permissions, rather
+# than those of the file and the moment it was cooked, and text is deflated at
+# deflate_level. Images and fonts are listed in file name order in every cook.
+# Every cook writes the sha256 of the .epub beside it in <book>.epub.sha256.
+deflate_level = 6 # zlib's default, named so a new default can't change the output
+
+def zipDateTime():
+    if 'SOURCE_DATE_EPOCH' in os.environ:
+        return max(time.gmtime(int(os.environ['SOURCE_DATE_EPOCH']))[:6], (1980, 1, 1, 0, 0, 0))
+    return (1980, 1, 1, 0, 0, 0) # the earliest a zip entry can have
+
+def zipInfo(arcname, src=None, compress_type=zipfile.ZIP_DEFLATED):
+    # the entry for a file (src) or text, timestamped as it always was unless deterministic
+    if not deterministic:
+        if src:
+            zinfo = zipfile.ZipInfo.from_file(src, arcname)
+        else:
+            zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+            zinfo.external_attr = 0o600 << 16 # as ZipFile.writestr
+    else:
+        zinfo = zipfile.ZipInfo(arcname, zipDateTime())
+        zinfo.create_system = 3 # unix, wherever it was cooked
+        zinfo.external_attr = 0o644 << 16
+    zinfo.compress_type = compress_type
+    return zinfo
+
+def writeZipText(fout, arcname, data, compress_type=zipfile.ZIP_DEFLATED):
+    # ZipFile.writestr, deterministic when asked
+    if not deterministic:
+        fout.writestr(arcname, data, compress_type = compress_type)
+    else:
+        fout.writestr(zipInfo(arcname, None, compress_type), data, compresslevel = deflate_level)
+
+def writeZipFile(fout, src, arcname, compress_type=zipfile.ZIP_DEFLATED):
+    # ZipFile.write, deterministic when asked
+    if not deterministic:
+        fout.write(src, arcname, compress_type = compress_type)
+    else:
+        with open(src, 'rb') as f:
+            fout.writestr(zipInfo(arcname, src, compress_type), f.read(), compresslevel = deflate_level)
+
+def epubDigest(epub_file):
+    # sha256 of an .epub, a path or a file object such as io.BytesIO
+    if not isinstance(epub_file, str):
+        return hashlib.sha256(epub_file.getvalue()).hexdigest()
+    h = hashlib.sha256()
+    with open(epub_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def readDigest(epub_path):
+    # the sha256 written beside an .epub by the last cook, None if there isn't one
+    try:
+        with open(epub_path +'.sha256', 'r') as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+def writeDigest(epub_path, digest):
+    # in the format of sha256sum, so sha256sum -c can check it
+    with open(epub_path +'.sha256', 'w') as f:
+        f.write(digest +'  '+ os.path.basename(epub_path) +'\n')
+
+# Images and fonts are already compressed and rarely change, so their zip
+# entries are kept in a content addressed cache (asset_cache/) and copied into
+# new archives as they are. Assets which deflate can't shrink by at least
+# deflate_min_saving are stored uncompressed.
+deflate_min_saving = 0.05
+asset_index = None
+asset_index_dir = None # the asset_cache asset_index was read from
+asset_index_changed = False # since it was read or saved
+asset_blob_min_age = 3600 # seconds, so a blob another cook has just written isn't collected
+
+def isBinaryAsset(path):
+    return path.startswith('images/') or path.startswith('fonts/') \
+        or path.startswith('OEBPS/images/') or path.startswith('OEBPS/fonts/')
+
+def loadAssetIndex():
+    # entries: sha1 of the file -> how it is stored in a zip,
+    # files: path -> size, modification time and sha1, to skip hashing
+    global asset_index, asset_index_dir, asset_index_changed
+    if asset_index is None or asset_index_dir != dirs['asset_cache']:
+        try:
+            with open(join(dirs['asset_cache'], 'index.json'), 'r') as f:
+                asset_index = json.load(f)
+        except:
+            asset_index = {'entries': {}, 'files': {}}
+        asset_index_dir = dirs['asset_cache']
+        asset_index_changed = pruneAssetIndex(asset_index)
+    return asset_index
+
+def pruneAssetIndex(index):
+    # forget files which are gone, and the entries (and .deflate blobs) no file
+    # has any more, so the index doesn't grow with every folder ever cooked.
+    # Returns True if anything was forgotten.
+    gone = [path for path in index['files'] if not os.path.exists(path)]
+    for path in gone:
+        del index['files'][path]
+    in_use = set([known[2] for known in index['files'].values()])
+    unused = [sha1 for sha1 in index['entries'] if sha1 not in in_use]
+    for sha1 in unused:
+        del index['entries'][sha1]
+    if os.path.isdir(dirs['asset_cache']):
+        for name in os.listdir(dirs['asset_cache']):
+            blob = join(dirs['asset_cache'], name)
+            if name.endswith('.deflate') and name[:-len('.deflate')] not in index['entries']:
+                try:
+                    if time.time() - os.stat(blob).st_mtime > asset_blob_min_age:
+                        os.remove(blob)
+                except OSError: # eg. another cook collected it first
+                    pass
+    return bool(gone or unused)
+
+def saveAssetIndex():
+    global asset_index_changed
+    if asset_index is None or not asset_index_changed:
+        return
+    if not os.path.exists(dirs['asset_cache']):
+        os.makedirs(dirs['asset_cache'])
+    index_file = join(dirs['asset_cache'], 'index.json')
+    with open(index_file + '.' + str(os.getpid()), 'w') as f:
+        json.dump(asset_index, f)
+    os.replace(index_file + '.' + str(os.getpid()), index_file) # other cooks may be reading it
+    asset_index_changed = False
+
+def cachedEntry(index, sha1):
+    # an index entry is only usable if its .deflate blob is still on disk
+    entry = index['entries'].get(sha1)
+    if entry is None:
+        return False
+    if entry['compress_type'] == zipfile.ZIP_DEFLATED:
+        return os.path.exists(join(dirs['asset_cache'], sha1+'.deflate'))
+    return True
+
+def indexedHash(src):
+    # sha1 of a file, hashed again only when its size or modification time changes
+    global asset_index_changed
+    index = loadAssetIndex()
+    src = os.path.abspath(src)
+    src_stat = os.stat(src)
+    known = index['files'].get(src)
+    if known and known[0] == src_stat.st_size and known[1] == src_stat.st_mtime_ns:
+        return known[2]
+    sha1 = hashFile(src)
+    index['files'][src] = [src_stat.st_size, src_stat.st_mtime_ns, sha1]
+    asset_index_changed = True
+    return sha1
+
+def assetEntry(src, arcname):
+    # the cached zip entry for an asset, compressing it first if it is new
+    global asset_index_changed
+    index = loadAssetIndex()
+    src = os.path.abspath(src)
+    src_stat = os.stat(src)
+    known = index['files'].get(src)
+    if known and known[0] == src_stat.st_size and known[1] == src_stat.st_mtime_ns \
+       and cachedEntry(index, known[2]):
+        return known[2], index['entries'][known[2]]
+
+    with open(src, 'rb') as f:
+        data = f.read()
+    sha1 = hashlib.sha1(data).hexdigest()
+    if not cachedEntry(index, sha1):
+        started = time.perf_counter()
+        compressor = zlib.compressobj(deflate_level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        elapsed = time.perf_counter() - started
+        ratio = float(len(deflated)) / max(len(data), 1)
+        entry = {'crc': zlib.crc32(data) & 0xffffffff, 'file_size': len(data)}
+        if ratio <= 1 - deflate_min_saving:
+            entry['compress_type'] = zipfile.ZIP_DEFLATED
+            entry['compress_size'] = len(deflated)
+            if not os.path.exists(dirs['asset_cache']):
+                os.makedirs(dirs['asset_cache'])
+            cache_file = join(dirs['asset_cache'], sha1+'.deflate')
+            with open(cache_file + '.' + str(os.getpid()), 'wb') as f:
+                f.write(deflated)
+            os.replace(cache_file + '.' + str(os.getpid()), cache_file)
+        else:
+            entry['compress_type'] = zipfile.ZIP_STORED
+            entry['compress_size'] = len(data)
+        index['entries'][sha1] = entry
+        msg("asset %s: deflate took %.1fms, ratio %.2f, %s", arcname, elapsed * 1000, ratio,
+            'deflated' if entry['compress_type'] == zipfile.ZIP_DEFLATED else 'stored', level=DEBUG)
+    if index['files'].get(src) != [src_stat.st_size, src_stat.st_mtime_ns, sha1]:
+        index['files'][src] = [src_stat.st_size, src_stat.st_mtime_ns, sha1]
+        asset_index_changed = True
+    return sha1, index['entries'][sha1]
+
+# zipfile has no public way to add an already compressed entry. The raw copy
+# in writeAsset does what ZipFile.open(zinfo, 'w') does, minus the
+# compressing, using zipfile internals which are unchanged from 3.6 to 3.13.
+# On any other version the asset is compressed again with writestr, which at
+# the same deflate_level gives the same bytes, only slower.
+raw_zip_copy = (3, 6) <= sys.version_info[:2] <= (3, 13) and \
+    all(hasattr(zipfile.ZipFile, name) for name in ('_writecheck', 'writestr')) and \
+    hasattr(zipfile.ZipInfo, 'FileHeader')
+
+def writeAsset(fout, src, arcname):
+    # copy an asset's cached zip entry into the archive without compressing it again
+    sha1, entry = assetEntry(src, arcname)
+    zinfo = zipInfo(arcname, src, entry['compress_type'])
+    if not raw_zip_copy:
+        msg("asset %s: compressed again, no raw zip copy on python %s", arcname,
+            platform.python_version(), level=DEBUG)
+        with open(src, 'rb') as f:
+            fout.writestr(zinfo, f.read(), compresslevel=deflate_level)
+        return
+    if entry['compress_type'] == zipfile.ZIP_DEFLATED:
+        with open(join(dirs['asset_cache'], sha1+'.deflate'), 'rb') as f:
+            data = f.read()
+    else:
+        with open(src, 'rb') as f:
+            data = f.read()
+    zinfo.CRC = entry['crc']
+    zinfo.file_size = entry['file_size']
+    zinfo.compress_size = len(data)
+    with fout._lock:
+        if fout._seekable:
+            fout.fp.seek(fout.start_dir)
+        zinfo.header_offset = fout.fp.tell()
+        fout._writecheck(zinfo)
+        fout._didModify = True
+        fout.fp.write(zinfo.FileHeader())
+        fout.fp.write(data)
+        fout.filelist.append(zinfo)
+        fout.NameToInfo[zinfo.filename] = zinfo
+        fout.start_dir = fout.fp.tell()
+
 def createArchive(rootDir, outputPath):
-    msg("zipping up to .epub at: "+ outputPath)
+    # outputPath may be a file object (eg. io.BytesIO) for an in memory cook
+    msg("zipping up to .epub at: "+ str(outputPath))
     # create served directory if it does not exist.
-    createEmptyDir(dirs['epub_loc'], False)
+    if isinstance(outputPath, str):
+        createEmptyDir(dirs['epub_loc'], False)
     fout = zipfile.ZipFile(outputPath, 'w')
-    cwd = os.getcwd()
-    os.chdir(rootDir)
-    fout.write('mimetype', compress_type = zipfile.ZIP_STORED)
+    writeZipFile(fout, join(rootDir, 'mimetype'), 'mimetype', zipfile.ZIP_STORED)
     fileList = []
     fileList.append(os.path.join('META-INF', 'container.xml'))
     fileList.append(os.path.join('OEBPS', 'package.opf'))
@@ -902,91 +2115,1420 @@ def createArchive(rootDir, outputPath):
     for itemPath in manifest_items():
         fileList.append(os.path.join('OEBPS', itemPath))
     for filePath in fileList:
-        fout.write(filePath, compress_type = zipfile.ZIP_DEFLATED)
+        if isBinaryAsset(filePath.replace(os.sep, '/')):
+            writeAsset(fout, join(rootDir, filePath), filePath.replace(os.sep, '/'))
+        else:
+            writeZipFile(fout, join(rootDir, filePath), filePath)
     fout.close()
-    os.chdir(cwd)
+    saveAssetIndex()
 
-def epubcheck(checkerPath, epubPath):
-    if os.name == 'posix': # linux server
-        f = open('tmp.txt','w')
-        subprocess.call(['epubcheck' + ' ' + epubPath], shell = True, stdout = f) 
-        f.close()
-        f = open('tmp.txt','r')
-        output = f.read()
-        msg(output)
-        f.close()
-    else: 
-        subprocess.call(['java', '-jar', checkerPath, epubPath], shell = True)
+def posPages(_recipe):
+    # front and back matter pages whose templates use point_of_sale data,
+    # these are the only pages which differ between personalized copies.
+    pages = []
+    for page in _recipe['front_matter'] + _recipe['back_matter']:
+        with codecs.open(join(dirs['template_dir'], page['name']+'.xhtml'), 'r', 'utf-8') as f:
+            if 'point_of_sale' in f.read():
+                pages.append(page)
+    return pages
+
+def writePOSBase(_recipe):
+    # cook once, stamp per purchaser:
+    # write an archive of everything except the point of sale pages, plus the
+    # recipe needed to render those pages, so each sale only renders a few pages.
+    pos_pages = posPages(_recipe)
+    msg("point of sale pages: "+ ", ".join([page['name'] for page in pos_pages]))
+    fout = zipfile.ZipFile(dirs['pos_base'], 'w')
+    gen_dir = dirs['gen_dir']
+    writeZipFile(fout, join(gen_dir, 'mimetype'), 'mimetype', zipfile.ZIP_STORED)
+    writeZipFile(fout, join(gen_dir, 'META-INF', 'container.xml'), 'META-INF/container.xml')
+    writeZipFile(fout, join(gen_dir, 'OEBPS', 'package.opf'), 'OEBPS/package.opf')
+    for itemPath in manifest_items():
+        if itemPath in [page['src'] for page in pos_pages]:
+            continue
+        if isBinaryAsset(itemPath):
+            writeAsset(fout, join(gen_dir, 'OEBPS', itemPath), 'OEBPS/'+itemPath)
+        else:
+            writeZipFile(fout, join(gen_dir, 'OEBPS', itemPath), 'OEBPS/'+itemPath)
+    fout.close()
+    saveAssetIndex()
 
-def kindlegen(checkerPath, epubPath):
-    if os.name == 'posix': # linux server
-        f = open('tmp.txt','w')
-        subprocess.call([checkerPath + ' ' + epubPath], shell = True, stdout = f)
-        f.close()
-        f = open('tmp.txt','r')
-        output = f.read()
-        msg(output)
-        f.close()
+    # the chapter text is already in the base archive, no need to keep it
+    base_recipe = dict(_recipe)
+    base_recipe['chapters'] = []
+    for chapter in _recipe['chapters']:
+        chapter = dict(chapter)
+        chapter.pop('scenes', None)
+        base_recipe['chapters'].append(chapter)
+    base_recipe['pos_pages'] = pos_pages
+    # plain dictionaries and lists, so the pickle loads wherever cook is imported from
+    with open(dirs['pos_recipe'], 'wb') as f:
+        pickle.dump(plainData(base_recipe), f)
+    msg("point of sale base archive at: "+ dirs['pos_base'])
+
+def loadPOSBase():
+    # read the recipe written by writePOSBase
+    if not os.path.isfile(dirs['pos_recipe']):
+        msg("***ERROR, no point of sale base found, run: python cook.py "+ file_name +" pos***", level=ERROR)
+        raise SystemExit
+    with open(dirs['pos_recipe'], 'rb') as f:
+        _recipe = pickle.load(f)
+    return _recipe
+
+def stampPOS(_recipe, point_of_sale, epub_path, base_archive=None):
+    # copy the base archive and add the point of sale pages for one purchaser.
+    # epub_path may be a file object (eg. io.BytesIO) instead of a path,
+    # base_archive the base's bytes when they are already in memory.
+    _recipe = dict(_recipe)
+    _recipe['point_of_sale'] = point_of_sale
+    if base_archive is not None and isinstance(epub_path, str):
+        with open(epub_path, 'wb') as f:
+            f.write(base_archive)
+    elif base_archive is not None:
+        epub_path.write(base_archive)
+    elif isinstance(epub_path, str):
+        shutil.copyfile(dirs['pos_base'], epub_path)
     else:
-        subprocess.call([checkerPath, epubPath], shell = True)
+        with open(dirs['pos_base'], 'rb') as f:
+            shutil.copyfileobj(f, epub_path)
+    fout = zipfile.ZipFile(epub_path, 'a')
+    for page in _recipe['pos_pages']:
+        out = renderPage(_recipe, page['name'])
+        writeZipText(fout, 'OEBPS/'+page['src'], out.encode('utf-8'))
+    fout.close()
+    return epub_path
+
+# transaction ids go into file names (and serve's Content-Disposition header)
+transaction_id_re = re.compile(r'^[A-Za-z0-9_.\-]+$')
+
+def posDataError(point_of_sale):
+    # what is wrong with point of sale data, None when it can be stamped
+    if point_of_sale is None:
+        return None
+    if not isinstance(point_of_sale, dict):
+        return 'point of sale data must be a mapping, not: '+ repr(point_of_sale)[:60]
+    if 'transaction_id' in point_of_sale \
+       and not transaction_id_re.match(str(point_of_sale['transaction_id'])):
+        return 'transaction_id may only have letters, digits, _, . and -, not: '+ repr(point_of_sale['transaction_id'])[:60]
+    return None
+
+def posEpubName(point_of_sale, book=None):
+    # one .epub per purchaser, named by transaction where there is one
+    book = book or file_name
+    if point_of_sale and 'transaction_id' in point_of_sale:
+        error = posDataError(point_of_sale)
+        if error:
+            raise ValueError(error)
+        return book + '_' + str(point_of_sale['transaction_id']) + '.epub'
+    return book + '.epub'
+
+def readPOSRecords(records_loc):
+    # many point of sale records from one file, either JSON (an array of
+    # records, or JSON lines with one record per line) or YAML with one
+    # document per record
+    import yaml
+    with codecs.open(records_loc, 'r', 'utf-8') as f:
+        if records_loc.endswith('.jsonl') or records_loc.endswith('.json'):
+            text = f.read()
+            try:
+                records = json.loads(text)
+                if not isinstance(records, list):
+                    records = [records]
+            except ValueError: # not one JSON document, so JSON lines
+                records = [json.loads(line) for line in text.splitlines() if line.strip()]
+        else:
+            records = [record for record in yaml.safe_load_all(f) if record]
+    return records
+
+def duplicateTransactions(records):
+    # transaction ids which more than one record has, their copies would overwrite each other
+    seen = set()
+    duplicates = []
+    for point_of_sale in records:
+        if point_of_sale and 'transaction_id' in point_of_sale:
+            transaction_id = str(point_of_sale['transaction_id'])
+            if transaction_id in seen and transaction_id not in duplicates:
+                duplicates.append(transaction_id)
+            seen.add(transaction_id)
+    return duplicates
+
+pos_base_recipe = None # set in each batch worker process
+
+def initStampWorker(settings, base_recipe):
+    global pos_base_recipe
+    setupBook(*settings)
+    pos_base_recipe = base_recipe
+
+def stampRecord(numbered_record):
+    # stamp one record in a batch worker, returns the path and seconds taken
+    record_nbr, point_of_sale = numbered_record
+    started = time.time()
+    if point_of_sale and 'transaction_id' in point_of_sale:
+        epub_name = posEpubName(point_of_sale)
+    else: # don't let records without a transaction overwrite each other
+        epub_name = file_name + '_' + str("%06d" % (record_nbr,)) + '.epub'
+    epub_path = join(dirs['epub_loc'], epub_name)
+    stampPOS(pos_base_recipe, point_of_sale, epub_path)
+    return epub_path, time.time() - started
+
+def stampBatch(records_loc):
+    # fan a file of point of sale records out over a process pool,
+    # the book itself has already been cooked once by writePOSBase.
+    records = readPOSRecords(records_loc)
+    msg("point of sale records: "+ str(len(records)) + " from " + records_loc)
+    errors = ["record %d: %s" % (record_nbr + 1, posDataError(point_of_sale))
+              for record_nbr, point_of_sale in enumerate(records) if posDataError(point_of_sale)]
+    if errors:
+        for error in errors:
+            msg("***ERROR in "+ records_loc +", "+ error +"***", level=ERROR)
+        raise SystemExit(2)
+    duplicates = duplicateTransactions(records)
+    if duplicates:
+        msg("***ERROR, more than one record with transaction_id: "+ ", ".join(duplicates) +"***", level=ERROR)
+        raise SystemExit(1)
+    base_recipe = loadPOSBase()
+    if not os.path.exists(dirs['epub_loc']):
+        os.makedirs(dirs['epub_loc'])
+
+    flushLog() # don't let worker processes inherit unwritten log lines
+    started = time.time()
+    pool = multiprocessing.Pool(initializer = initStampWorker, initargs = (bookSettings(), base_recipe))
+    try:
+        results = pool.map(stampRecord, list(enumerate(records)), chunksize = 16)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - started
+
+    if results:
+        per_record = sum([seconds for epub_path, seconds in results]) / len(results)
+        msg("stamped " + str(len(results)) + " copies in %.2fs (%.1f per second, %.1fms per record)"
+            % (elapsed, len(results) / max(elapsed, 1e-6), per_record * 1000))
+    return [epub_path for epub_path, seconds in results]
+
+# "serve" keeps worker processes with the point of sale bases of the books
+# loaded, each POST of point of sale data gets a personalized .epub back:
+#   curl --data-binary @demo_raw/demo_pos_data.txt http://127.0.0.1:8000/demo -o copy.epub
+# GET /metrics shows the latency of each stage.
+served_books = {} # book: (base recipe, base archive bytes), in each serve worker
+book_name_re = re.compile(r'^[A-Za-z0-9_\-]+$')
+serve_max_body = 64 * 1024 # point of sale data is a few lines
+
+def loadServedBook(book):
+    # the point of sale base of a book, read once by each worker
+    if book not in served_books:
+        setupBook(book, 'serve', None, options, book_dir)
+        if not os.path.isfile(dirs['pos_recipe']):
+            return None
+        _recipe = loadPOSBase()
+        with open(dirs['pos_base'], 'rb') as f:
+            base_archive = f.read()
+        for page in _recipe['pos_pages']:
+            loadTemplate(join(dirs['template_dir'], page['name']+'.xhtml'))
+        served_books[book] = (_recipe, base_archive)
+    return served_books[book]
+
+def initServeWorker(settings, books):
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C stops the server, which stops the workers
+    setupBook(*settings)
+    for book in books:
+        loadServedBook(book)
+
+def serveStamp(book, point_of_sale, queued_at):
+    # stamp one copy in a serve worker, returns the .epub bytes (None for
+    # an unknown book) and the seconds spent in each stage
+    started = time.time()
+    timings = {'queue': started - queued_at}
+    served_book = loadServedBook(book)
+    timings['load'] = time.time() - started
+    if served_book is None:
+        return None, timings
+    setupBook(book, 'serve', None, options, book_dir)
+    _recipe, base_archive = served_book
+    rendering = sum([stats[1] for stats in template_stats.values()])
+    stamping = time.time()
+    epub_file = stampPOS(_recipe, point_of_sale, io.BytesIO(), base_archive)
+    timings['stamp'] = time.time() - stamping
+    timings['render'] = sum([stats[1] for stats in template_stats.values()]) - rendering
+    timings['zip'] = timings['stamp'] - timings['render']
+    return epub_file.getvalue(), timings
+
+serve_metrics = {} # stage: [requests, total seconds, max seconds]
+serve_counts = {'requests': 0, 'rejected': 0, 'errors': 0, 'in_flight': 0}
+serve_lock = threading.Lock()
+
+def recordLatency(timings):
+    with serve_lock:
+        for stage, seconds in timings.items():
+            if stage not in serve_metrics:
+                serve_metrics[stage] = [0, 0.0, 0.0]
+            serve_metrics[stage][0] +=1
+            serve_metrics[stage][1] += seconds
+            serve_metrics[stage][2] = max(serve_metrics[stage][2], seconds)
+
+def serveMetrics():
+    with serve_lock:
+        report = dict(serve_counts)
+        # requests beyond one per worker are waiting for a worker
+        report['waiting'] = max(0, serve_counts['in_flight'] - CookRequestHandler.workers)
+        report['stages'] = {}
+        for stage, (requests, total, longest) in serve_metrics.items():
+            report['stages'][stage] = {'requests': requests,
+                                       'mean_ms': round(total / requests * 1000, 2),
+                                       'max_ms': round(longest * 1000, 2)}
+    return report
+
+class CookRequestHandler(BaseHTTPRequestHandler):
+    # set by serveBooks
+    pool = None
+    workers = 0
+    slots = None # one per worker plus --queue, for the requests waiting for a worker
+
+    def sendBody(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendError(self, status, error):
+        self.sendBody(status, 'application/json', json.dumps({'error': error}).encode('utf-8'))
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.sendBody(200, 'application/json', json.dumps(serveMetrics(), indent=2).encode('utf-8'))
+        else:
+            self.sendError(404, 'POST point of sale data to /<book>, or GET /metrics')
+
+    def do_POST(self):
+        started = time.time()
+        book = self.path.strip('/') or file_name
+        if not book_name_re.match(book):
+            return self.sendError(404, 'no such book: '+ book)
+        # point of sale data as JSON, or YAML like <book>_pos_data.txt
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self.sendError(400, 'bad Content-Length: '+ str(self.headers.get('Content-Length')))
+        if length > serve_max_body:
+            self.close_connection = True # the body is never read
+            return self.sendError(413, 'point of sale data may be up to %d bytes' % (serve_max_body,))
+        try:
+            payload = self.rfile.read(length).decode('utf-8')
+        except UnicodeDecodeError:
+            return self.sendError(400, 'point of sale data must be UTF-8')
+        try:
+            point_of_sale = json.loads(payload)
+        except ValueError:
+            import yaml
+            try:
+                point_of_sale = yaml.safe_load(payload)
+            except yaml.YAMLError:
+                point_of_sale = None
+        if posDataError(point_of_sale): # transaction_id goes into the Content-Disposition header
+            return self.sendError(400, posDataError(point_of_sale))
+
+        if not self.slots.acquire(False):
+            with serve_lock:
+                serve_counts['rejected'] +=1
+            return self.sendError(503, 'too many requests waiting, try again')
+        try:
+            with serve_lock:
+                serve_counts['in_flight'] +=1
+            epub_file, timings = self.pool.apply(serveStamp, (book, point_of_sale, time.time()))
+        except Exception as e:
+            with serve_lock:
+                serve_counts['errors'] +=1
+            msg("***ERROR while stamping "+ book +"***: "+ str(e), level=ERROR)
+            return self.sendError(500, str(e))
+        finally:
+            with serve_lock:
+                serve_counts['in_flight'] -=1
+            self.slots.release()
+        if epub_file is None:
+            return self.sendError(404, 'no point of sale base for: '+ book +', run: python cook.py '+ book +' pos')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/epub+zip')
+        self.send_header('Content-Length', str(len(epub_file)))
+        self.send_header('Content-Disposition', 'attachment; filename="'+ posEpubName(point_of_sale, book) +'"')
+        self.end_headers()
+        self.wfile.write(epub_file)
+        timings['request'] = time.time() - started
+        with serve_lock:
+            serve_counts['requests'] +=1
+        recordLatency(timings)
+
+    def log_message(self, format, *args):
+        msg("serve: "+ (format % args))
+
+def serveBooks(port=8000, workers=None, queue=None):
+    # serve personalized copies on localhost until Ctrl-C.
+    # Each worker stamps one copy at a time, up to queue more requests (default
+    # four per worker) wait for a worker, any more are turned away with a 503.
+    workers = workers or multiprocessing.cpu_count()
+    if queue is None:
+        queue = workers * 4
+    flushLog() # don't let worker processes inherit unwritten log lines
+    CookRequestHandler.pool = multiprocessing.Pool(workers, initializer = initServeWorker,
+                                                   initargs = (bookSettings(), [file_name]))
+    CookRequestHandler.workers = workers
+    CookRequestHandler.slots = threading.BoundedSemaphore(workers + queue)
+    server = ThreadingHTTPServer(('127.0.0.1', port), CookRequestHandler)
+    server.daemon_threads = True
+    msg("serving %s with %d workers (and %d waiting) at http://127.0.0.1:%d/%s, Ctrl-C to stop"
+        % (file_name, workers, queue, port, file_name))
+    flushLog()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        CookRequestHandler.pool.terminate()
+        CookRequestHandler.pool.join()
+
+def timeBest(func, repeat=5):
+    # best wall time of several runs, in seconds
+    best = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def readSceneLines(scene_name):
+    with codecs.open(join(dirs['raw_book'], scene_name+'.txt'), 'r', 'utf-8') as in_file:
+        return in_file.readlines()
+
+def benchMarkdown(scenes_dict):
+    # compare rendering each paragraph with markdown.markdown against
+    # rendering whole scenes with one reused markdown instance
+    scenes = []
+    for chapter_code in sorted(scenes_dict):
+        for scene_name in scenes_dict[chapter_code]:
+            scenes.append(readSceneLines(scene_name))
+
+    differences = 0
+    for lines in scenes:
+        if formatScene(lines, 0, recipe['auto_dropcaps'], False) != \
+           formatScene(lines, 0, recipe['auto_dropcaps'], True):
+            differences +=1
+            msg("***ERROR, per scene markdown differs from per paragraph markdown***", level=ERROR)
+    golden_differences['formatScene'] = differences
+
+    per_para = timeBest(lambda: [formatScene(lines, 0, recipe['auto_dropcaps'], False) for lines in scenes])
+    per_scene = timeBest(lambda: [formatScene(lines, 0, recipe['auto_dropcaps'], True) for lines in scenes])
+    msg("markdown for %d scenes, per paragraph: %.1fms, per scene: %.1fms (%.1fx faster)"
+        % (len(scenes), per_para * 1000, per_scene * 1000, per_para / per_scene))
+    return per_scene # formatScene for every scene of the book
+
+def benchParagraphs(scenes_dict):
+    # compare Paragraph objects with the dictionaries they replaced: memory
+    # for the paragraphs of the whole book, and rendering them with chapter.xhtml
+    paragraphs = []
+    for chapter_code in sorted(scenes_dict):
+        for scene_name in scenes_dict[chapter_code]:
+            paragraphs = paragraphs + formatScene(readSceneLines(scene_name), 0, recipe['auto_dropcaps'])['paras']
+
+    tracemalloc.start()
+    as_objects = [Paragraph(para.words, para.para_class, para.text_class) for para in paragraphs]
+    object_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    tracemalloc.start()
+    as_dicts = [para.asDict() for para in paragraphs]
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    msg("memory for %d paragraphs, dictionaries: %.0fKB, Paragraph: %.0fKB (%.1fx smaller)"
+        % (len(paragraphs), dict_bytes / 1024.0, object_bytes / 1024.0, dict_bytes / max(object_bytes, 1)))
+
+    chapter = {'nbr': '1', 'id': 'h2-1', 'name': 'Bench', 'scenes': [{'paras': as_objects}]}
+    dict_chapter = dict(chapter, scenes = [{'paras': as_dicts}])
+    if renderTemplate('chapter.xhtml', chapter) != renderTemplate('chapter.xhtml', dict_chapter):
+        msg("***ERROR, chapter.xhtml differs for Paragraph objects and dictionaries***", level=ERROR)
+    dict_render = timeBest(lambda: renderTemplate('chapter.xhtml', dict_chapter), 3)
+    object_render = timeBest(lambda: renderTemplate('chapter.xhtml', chapter), 3)
+    msg("chapter.xhtml for %d paragraphs, dictionaries: %.1fms, Paragraph: %.1fms (%.1fx)"
+        % (len(paragraphs), dict_render * 1000, object_render * 1000, dict_render / object_render))
+    return object_render
+
+golden_differences = {} # bench check: outputs which differ from what the faster code replaced
+
+# chapters for checking directChapterXhtml, on top of the book's own chapters
+chapter_samples = [
+    {'nbr': '1', 'id': 'h2-1', 'name': 'Fish &amp; "chips"', 'title': 'A <title> & "more"',
+     'starts_part': 'Part <One> & Two', 'photo': 'frog & "friend".jpg', 'intro': 'Line one\n\n  \nline two',
+     'scenes': [{'paras': [Paragraph('<p>one</p>', 'texttop', 'bold'), Paragraph('   '), Paragraph(''),
+                           Paragraph('<ul>\n\n<li>one</li>\r\n  \n<li>two</li>\n</ul>\n'),
+                           Paragraph('<p>a\u2028b\x0c\x0c</p>', 'clearit')]},
+                {'divider': True}, {'paras': [Paragraph('\n<p>last\xa0</p>\n'), Paragraph('\xa0')]}]},
+    {'nbr': '2', 'id': 'h2-2', 'name': '', 'scenes': []},
+    ]
+
+def benchChapters(scenes_dict):
+    # check directChapterXhtml against chapter.xhtml (golden output), then time both
+    chapters = list(chapter_samples)
+    counts = {'paragraphs': 0}
+    for chapter in recipe['chapters']:
+        chapters.append(dict(chapter, scenes = list(chapterScenes(scenes_dict[chapter['code']], counts, False))))
+
+    differences = 0
+    for chapter in chapters:
+        if templateChapterXhtml(chapter) != directChapterXhtml(chapter):
+            differences +=1
+            msg("***ERROR, direct chapter xhtml differs for chapter: "+ chapter['nbr'] +"***", level=ERROR)
+    msg("chapter golden check: %d of %d chapters differ" % (differences, len(chapters)))
+    golden_differences['chapterXhtml'] = differences
+
+    template = timeBest(lambda: [templateChapterXhtml(chapter) for chapter in chapters], 3)
+    direct = timeBest(lambda: [directChapterXhtml(chapter) for chapter in chapters], 3)
+    msg("%d chapters (%d paragraphs), chapter.xhtml: %.1fms, direct: %.1fms (%.1fx faster)"
+        % (len(chapters), counts['paragraphs'], template * 1000, direct * 1000, template / direct))
+    return direct
+
+# lines for checking the typography rules, on top of the book's own paragraphs
+typography_samples = [
+    '<p>"Hello," she said. "Goodbye."</p>',
+    "<p>'Tis the season, 'quoted' he said.' It's Bob's.</p>",
+    '<p>Wait... "What..." and... "Really?" "Yes!" ok</p>',
+    '<p>Fish &amp; chips &amp; peas, R&amp;D, AT&T, &pound;5, &rsquo;ello &lsquo;</p>',
+    '<p>Double  spaces   here    and "  spaced "  quotes</p>',
+    '<p>A <a href="http://example.com">link</a> and an <em>"emphasis"</em>.</p>',
+    '<p><img alt="frog" src="images/jazz_frog.jpg" /> "after"</p>',
+    '<ul>\n<li>"one"</li>\n<li>two...</li>\n</ul>',
+    '<h2>A "heading" ...</h2>',
+    'A chapter name with "quotes" & ampersands...',
+    ]
+
+def benchTypography(scenes_dict):
+    # time the typography engine, tests/test_typography.py checks its output
+    # against the chain of replaces it replaced.
+    lines = list(typography_samples)
+    for chapter in recipe['chapters']:
+        if chapter['name']:
+            lines.append(chapter['name'])
+    for chapter_code in sorted(scenes_dict):
+        for scene_name in scenes_dict[chapter_code]:
+            grouped_lines = []
+            non_blank_lines = removeBlankLines([line.strip() for line in readSceneLines(scene_name)])
+            n = 0
+            while n < len(non_blank_lines):
+                n, line = groupMarkdown(n, non_blank_lines)
+                grouped_lines.append(line)
+                n+=1
+            lines = lines + processMarkdownScene(grouped_lines)
+
+    engine = timeBest(lambda: [postMarkdownTextClean(line) for line in lines * 20])
+    msg("typography for %d lines: %.1fms" % (len(lines) * 20, engine * 1000))
+    return engine / 20 # postMarkdownTextClean for every line once
+
+# synthetic books for benchmarking, made of lorem ipsum with some markdown,
+# eg. python cook.py big synth --chapters 200 --scenes 4 --paras 40 --images 20 --parts 4
+synthetic_shape = {'chapters': 20, 'scenes': 3, 'paras': 30, 'images': 4, 'parts': 0, 'markdown': 0.2}
+synthetic_marker = '.synthetic' # marks a _raw folder writeSyntheticBook may overwrite
+
+def bookShape():
+    # the synthetic book shape from the command line options
+    shape = dict(synthetic_shape)
+    for option in shape:
+        if option in options:
+            shape[option] = type(shape[option])(options[option])
+    if shape['parts'] > shape['chapters']:
+        # every part starts at a chapter, so there can't be more parts than chapters
+        msg("WARNING: --parts %d is more than --chapters %d, writing %d parts"
+            % (shape['parts'], shape['chapters'], shape['chapters']), level=WARNING)
+        shape['parts'] = shape['chapters']
+    return shape
+
+def syntheticParagraph(rand, sentences, markdown_density):
+    # a paragraph of lorem ipsum, sometimes with some markdown and typography to clean
+    para = " ".join(rand.sample(sentences, rand.randint(2, 6)))
+    if rand.random() >= markdown_density:
+        return [para]
+    words = para.split(' ')
+    kind = rand.randint(0, 5)
+    if kind == 0: # emphasis and bold
+        words[1] = '_'+ words[1] +'_'
+        words[-2] = '**'+ words[-2] +'**'
+    elif kind == 1: # quotes and an elipsis
+        words[0] = '"'+ words[0]
+        words[3] = words[3] +'..." he said, \'quoted\''
+    elif kind == 2: # a link
+        words[2] = '[' + words[2] + '](http://example.com/'+ words[2].strip('.,') +')'
+    elif kind == 3: # a header
+        return ['## '+ " ".join(words[:4]).strip('.,')]
+    elif kind == 4: # a list, one item per line
+        return ['* '+ " ".join(words[n:n+4]) for n in range(0, min(len(words), 16), 4)]
+    else: # an ampersand
+        words[2] = words[2] +' &'
+    return [" ".join(words)]
+
+def writeSyntheticBook(shape, seed=1):
+    # write <book>_raw with a recipe, scenes and images of the given shape
+    import random
+    import yaml
+    raw_book = dirs['raw_book']
+    if os.path.exists(raw_book) and not os.path.isfile(join(raw_book, synthetic_marker)):
+        msg("***ERROR, "+ raw_book +" is not a synthetic book, not overwriting it***", level=ERROR)
+        raise SystemExit
+    createEmptyDir(raw_book, False)
+    os.makedirs(dirs['raw_images'])
+    with open(join(raw_book, synthetic_marker), 'w') as f:
+        json.dump(shape, f)
+    rand = random.Random(seed)
+    with codecs.open(join(dirs['template_dir'], 'lorem_ipsum.txt'), 'r', 'utf-8') as f:
+        sentences = [sentence.strip() + '.' for sentence in f.read().split('.') if sentence.strip()]
+
+    # images, copied round robin from the demo book
+    demo_images = sorted([name for name in os.listdir(dirs['default_cover']) if name.endswith('.jpg')])
+    shutil.copyfile(join(dirs['default_cover'], 'cover_image.jpg'), join(dirs['raw_images'], 'cover_image.jpg'))
+    images = []
+    for image_nbr in range(shape['images']):
+        images.append('image_%03d.jpg' % (image_nbr,))
+        shutil.copyfile(join(dirs['default_cover'], demo_images[image_nbr % len(demo_images)]),
+                        join(dirs['raw_images'], images[-1]))
+
+    # the recipe, from the template a new book gets
+    _recipe = yaml.safe_load(renderTemplate('recipe.mustache', {'file_name': file_name}))
+    _recipe['title'] = 'Synthetic ' + file_name
+    if shape['parts']:
+        _recipe['parts'] = [{'part_name': 'Part %d' % (part_nbr + 1,)} for part_nbr in range(shape['parts'])]
+    _recipe['chapters'] = []
+    for chapter_nbr in range(1, shape['chapters'] + 1):
+        code = '%03d' % (chapter_nbr,)
+        chapter = {'code': code, 'name': 'Chapter %d, "%s"' % (chapter_nbr, rand.choice(sentences)[:30].strip()),
+                   'intro': rand.choice(sentences)}
+        if images:
+            chapter['photo'] = images[chapter_nbr % len(images)]
+        part_nbr = (chapter_nbr - 1) * shape['parts'] // shape['chapters']
+        if shape['parts'] and (chapter_nbr - 1) * shape['parts'] % shape['chapters'] < shape['parts']:
+            chapter['starts_part'] = _recipe['parts'][part_nbr]['part_name']
+        _recipe['chapters'].append(chapter)
+
+        for scene_nbr in range(1, shape['scenes'] + 1):
+            lines = []
+            for para_nbr in range(shape['paras']):
+                lines = lines + syntheticParagraph(rand, sentences, shape['markdown']) + ['']
+            with codecs.open(join(raw_book, '_%s_%04d_scene.txt' % (code, scene_nbr * 10)), 'w', 'utf-8') as f:
+                f.write("\n".join(lines))
 
-#########################################################################
-if __name__ == "__main__": # main processing
+    for page in _recipe['front_matter'] + _recipe['back_matter']:
+        if page['name'] not in ['cover', 'title_page', 'table_of_contents']:
+            with codecs.open(join(raw_book, page['name']+'.txt'), 'w', 'utf-8') as f:
+                f.write(rand.choice(sentences))
+    with codecs.open(dirs['recipe_loc'], 'w', 'utf-8') as f:
+        yaml.safe_dump(_recipe, f, default_flow_style=False, sort_keys=False)
+    msg("synthetic book %s: %d chapters of %d scenes of %d paragraphs, %d images, %d parts"
+        % (file_name, shape['chapters'], shape['scenes'], shape['paras'], shape['images'], shape['parts']))
+
+def runBenchmarks():
+    # time the slow parts of a cook, eg. python cook.py demo bench
+    # The golden checks compare the faster code with what it replaced. Timings go
+    # to debug/bench_results.json, with --save-baseline to bench_baselines/<book>.json,
+    # timings more than --tolerance (default 0.2, ie. 20%) slower than the baseline
+    # are regressions. Shape options (--chapters etc.) write a synthetic book first.
+    # Returns the number of regressions plus the differences the golden checks found.
+    global recipe
+    golden_differences.clear()
+    if [option for option in synthetic_shape if option in options]:
+        writeSyntheticBook(bookShape())
+    repeat = int(options.get('repeat', 3))
+    recipe = importYaml(file_name)
+    scenes_dict = getScenesDict(dirs['raw_book'])
+    timings = {}
+    timings['formatScene'] = benchMarkdown(scenes_dict)
+    timings['postMarkdownTextClean'] = benchTypography(scenes_dict)
+    timings['chapterTemplate'] = benchParagraphs(scenes_dict)
+    timings['cook'] = timeBest(cookBook, repeat)
+    timings['chapterXhtml'] = benchChapters(scenes_dict)
+    counts = {'chapters': len(recipe['chapters']),
+              'scenes': sum([chapter_stats['scenes'] for chapter_stats in stage_report['chapters']]),
+              'paragraphs': sum([chapter_stats['paragraphs'] for chapter_stats in stage_report['chapters']]),
+              'images': len(recipe['images'])}
+    if not streaming:
+        epub_file = join(dirs['epub_loc'], file_name + '.epub')
+        timings['createArchive'] = timeBest(lambda: createArchive(dirs['gen_dir'], epub_file), repeat)
+        counts['epub_bytes'] = os.path.getsize(epub_file)
+    results = {'book': file_name, 'counts': counts,
+               'timings_ms': dict([(name, round(seconds * 1000, 2)) for name, seconds in timings.items()])}
+    for name in sorted(results['timings_ms']):
+        msg("bench %s: %.1fms" % (name, results['timings_ms'][name]))
+    with codecs.open(join(dirs['tmp'], 'bench_results.json'), 'w', 'utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    regressions = 0
+    if os.path.isfile(dirs['bench_baseline']):
+        with codecs.open(dirs['bench_baseline'], 'r', 'utf-8') as f:
+            baseline = json.load(f)
+        tolerance = float(options.get('tolerance', 0.2))
+        if baseline['counts'] != counts:
+            msg("WARNING: the baseline is for a different book: "+ json.dumps(baseline['counts']), level=WARNING)
+        for name, baseline_ms in sorted(baseline['timings_ms'].items()):
+            if name in results['timings_ms'] and results['timings_ms'][name] > baseline_ms * (1 + tolerance):
+                regressions +=1
+                msg("***REGRESSION*** %s: %.1fms, baseline %.1fms (%.0f%% slower)"
+                    % (name, results['timings_ms'][name], baseline_ms,
+                       (results['timings_ms'][name] / baseline_ms - 1) * 100), level=ERROR)
+        msg("bench compared with %s: %d regressions" % (dirs['bench_baseline'], regressions))
+    if options.get('save-baseline'):
+        if not os.path.exists(os.path.dirname(dirs['bench_baseline'])):
+            os.makedirs(os.path.dirname(dirs['bench_baseline']))
+        with codecs.open(dirs['bench_baseline'], 'w', 'utf-8') as f:
+            json.dump(results, f, indent=2)
+        msg("bench baseline saved to: "+ dirs['bench_baseline'])
+    for name, differences in sorted(golden_differences.items()):
+        if differences:
+            msg("***ERROR, %s golden check: %d differences***" % (name, differences), level=ERROR)
+    return regressions + sum(golden_differences.values())
+
+# Validation ("validate", or "--validate" with any mode): first a structural check
+# of the archive which takes milliseconds, then epubcheck, if it is installed, for
+# the epubs which pass it. epubcheck is "epubcheck" on the PATH, otherwise java
+# with the jar from "--epubcheck path/to/epubcheck.jar" (default ../epubcheck/epubcheck.jar).
+# Several epubs (a batch, a catalog) are checked at once, one epubcheck per --jobs
+# (or cpu), and epubcheck's results are cached by the sha1 of the epub so an
+# unchanged epub is not checked again.
+epub_mimetype = b'application/epub+zip'
+container_ns = '{urn:oasis:names:tc:opendocument:xmlns:container}'
+opf_ns = '{http://www.idpf.org/2007/opf}'
+validation_results = [] # the results of validateEpubs in this run
+
+def isValidating():
+    return arg2 in ['validate', 'kindlegen'] or bool(options.get('validate'))
+
+def checkStructure(epub_data):
+    # (errors, warnings) in the zip structure of an epub: the mimetype entry,
+    # container.xml, and the manifest of each package against the archive
+    import xml.etree.ElementTree as ElementTree
+    import posixpath
+    from urllib.parse import unquote
+    errors = []
+    warnings = []
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(epub_data))
+    except zipfile.BadZipFile as e:
+        return ['not a zip archive: '+ str(e)], warnings
+    entries = archive.infolist()
+    names = set(archive.namelist())
+    if not entries or entries[0].filename != 'mimetype':
+        errors.append('mimetype is not the first entry')
+    else:
+        if entries[0].compress_type != zipfile.ZIP_STORED:
+            errors.append('mimetype is compressed')
+        if entries[0].extra:
+            errors.append('mimetype has an extra field')
+        if archive.read('mimetype') != epub_mimetype:
+            errors.append('mimetype is not '+ epub_mimetype.decode('ascii'))
+    if 'META-INF/container.xml' not in names:
+        errors.append('META-INF/container.xml is missing')
+        return errors, warnings
+    try:
+        container = ElementTree.fromstring(archive.read('META-INF/container.xml'))
+    except ElementTree.ParseError as e:
+        errors.append('META-INF/container.xml: '+ str(e))
+        return errors, warnings
+
+    listed = set(['mimetype', 'META-INF/container.xml'])
+    package_paths = [rootfile.get('full-path') for rootfile in container.iter(container_ns+'rootfile')]
+    if not package_paths:
+        errors.append('META-INF/container.xml has no rootfile')
+    for package_path in package_paths:
+        if package_path not in names:
+            errors.append('rootfile '+ str(package_path) +' is not in the archive')
+            continue
+        listed.add(package_path)
+        try:
+            package = ElementTree.fromstring(archive.read(package_path))
+        except ElementTree.ParseError as e:
+            errors.append(package_path +': '+ str(e))
+            continue
+        item_ids = set()
+        for item in package.iter(opf_ns+'item'):
+            item_ids.add(item.get('id'))
+            href = item.get('href', '')
+            if '://' in href: # a remote resource
+                continue
+            href = posixpath.normpath(posixpath.join(posixpath.dirname(package_path), unquote(href)))
+            listed.add(href)
+            if href not in names:
+                errors.append('manifest item %s: %s is not in the archive' % (item.get('id'), href))
+        for itemref in package.iter(opf_ns+'itemref'):
+            if itemref.get('idref') not in item_ids:
+                errors.append('spine itemref %s is not in the manifest' % (itemref.get('idref'),))
+    for name in sorted(names - listed):
+        if not name.endswith('/') and not name.startswith('META-INF/'):
+            warnings.append(name +' is in the archive but not in the manifest')
+    return errors, warnings
+
+def epubcheckCommand(checkerPath):
+    # how to run epubcheck, None if it is not installed
+    if shutil.which('epubcheck'):
+        return ['epubcheck']
+    if os.path.isfile(checkerPath) and shutil.which('java'):
+        return ['java', '-jar', checkerPath]
+    return None
+
+def runChecker(command, epub_path):
+    # run a checker with its output captured, returns (return code, output)
+    try:
+        completed = subprocess.run(command + [epub_path], stdout = subprocess.PIPE,
+                                   stderr = subprocess.STDOUT, universal_newlines = True)
+    except OSError as e:
+        return None, 'could not run '+ ' '.join(command) +': '+ str(e)
+    return completed.returncode, completed.stdout
+
+# epubcheck's summary, in the output of every version that finished checking.
+# java -jar also exits 1 when java or the jar fails, those results aren't cached.
+epubcheck_finished_re = re.compile(r'^(Messages: |Check finished|EPUBCheck completed|No errors or warnings detected)',
+                                   re.MULTILINE | re.IGNORECASE)
+checker_versions = {} # installed command: epubcheck's version line, None if it doesn't say
+
+def checkerVersion(command):
+    # part of the validation cache key, so a new epubcheck checks every epub again.
+    # Asked once per install of the command, its files' paths and modification times.
+    installed = []
+    for part in [shutil.which(command[0]) or command[0]] + command[1:]:
+        if os.path.isfile(part):
+            installed.append([os.path.realpath(part), os.stat(part).st_mtime_ns])
+        else:
+            installed.append(part)
+    key = json.dumps(installed)
+    if key not in checker_versions:
+        returncode, output = runChecker(command, '--version')
+        versions = [line.strip() for line in (output or '').splitlines() if 'epubcheck' in line.lower()]
+        checker_versions[key] = versions[0] if versions else None
+    return checker_versions[key]
+
+def checkEpub(result, command, epub_data):
+    # epubcheck an epub for validateEpubs, an epub in memory goes through a temporary file
+    if isinstance(result['epub'], str):
+        result['returncode'], result['output'] = runChecker(command, result['epub'])
+        return
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        epub_path = join(tmp_dir, 'book.epub')
+        with open(epub_path, 'wb') as f:
+            f.write(epub_data)
+        result['returncode'], result['output'] = runChecker(command, epub_path)
+
+def validateEpubs(epub_files, checkerPath='../epubcheck/epubcheck.jar'):
+    # validate epubs, paths or bytes, returns the number which are not valid
+    command = epubcheckCommand(options.get('epubcheck') or checkerPath)
+    if command is None:
+        msg("WARNING: epubcheck not found, only the structure of the epub is checked", level=WARNING)
+    results = []
+    to_check = [] # (result, epub bytes, cache file)
+    for epub_file in epub_files:
+        if isinstance(epub_file, str):
+            with open(epub_file, 'rb') as f:
+                epub_data = f.read()
+        else:
+            epub_data = bytes(epub_file)
+        started = time.perf_counter()
+        result = {'epub': epub_file if isinstance(epub_file, str) else '(in memory)',
+                  'sha1': hashlib.sha1(epub_data).hexdigest()}
+        result['errors'], result['warnings'] = checkStructure(epub_data)
+        result['structure_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        results.append(result)
+        if result['errors'] or command is None:
+            continue
+        version = checkerVersion(command)
+        if version is None: # no way to tell results of another epubcheck apart
+            to_check.append((result, epub_data, None))
+            continue
+        cache_key = hashlib.sha1((result['sha1'] + json.dumps(command) + version).encode('utf-8')).hexdigest()
+        cache_file = join(dirs['validation_cache'], cache_key +'.json')
+        try:
+            with open(cache_file, 'r') as f:
+                result.update(json.load(f))
+            result['cached'] = True
+        except (OSError, ValueError):
+            to_check.append((result, epub_data, cache_file))
+
+    if to_check:
+        from concurrent.futures import ThreadPoolExecutor
+        # the checkers are processes of their own, the threads only wait for them
+        threads = jobs if jobs > 1 else multiprocessing.cpu_count()
+        with ThreadPoolExecutor(min(threads, len(to_check))) as pool:
+            for checked in [pool.submit(checkEpub, result, command, epub_data)
+                            for result, epub_data, cache_file in to_check]:
+                checked.result()
+        if not os.path.exists(dirs['validation_cache']):
+            os.makedirs(dirs['validation_cache'])
+        for result, epub_data, cache_file in to_check:
+            result['cached'] = False
+            # checked, valid or not, rather than epubcheck failing to run
+            if cache_file and result['returncode'] in [0, 1] and epubcheck_finished_re.search(result['output']):
+                with open(cache_file +'.'+ str(os.getpid()), 'w') as f:
+                    json.dump({'returncode': result['returncode'], 'output': result['output']}, f)
+                os.replace(cache_file +'.'+ str(os.getpid()), cache_file)
+
+    invalid = 0
+    for result in results:
+        result['valid'] = not result['errors'] and result.get('returncode', 0) == 0
+        for error in result['errors']:
+            msg("***ERROR in "+ result['epub'] +"***: "+ error, level=ERROR)
+        for warning in result['warnings']:
+            msg("WARNING in "+ result['epub'] +": "+ warning, level=WARNING)
+        if 'output' in result:
+            msg(result['output'].rstrip(), level=INFO if result['valid'] else ERROR)
+        msg("validated %s: %s (structure %.1fms%s)" % (result['epub'], 'valid' if result['valid'] else 'NOT VALID',
+            result['structure_ms'], ', epubcheck cached' if result.get('cached') else
+            (', epubcheck' if 'output' in result else '')))
+        if not result['valid']:
+            invalid +=1
+    validation_results.extend(results)
+    return invalid
 
+def kindlegen(checkerPath, epubPath):
+    returncode, output = runChecker([checkerPath], epubPath)
+    msg(output)
+
+epub_sha256 = None # of the last .epub cookBook wrote
+
+# wall time, cpu time, peak memory and counts of each stage of the cook
+# and each chapter, written to debug/stage_report.json
+stage_report = {'stages': [], 'chapters': []}
+
+def peakMemory():
+    # peak resident memory of this process so far in KB, None where unknown
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # bytes rather than KB
+        peak = peak // 1024
+    return peak
+
+def memoryStarted(reset_traced=True):
+    # what memoryUsed measures from. ru_maxrss only ever grows, so a stage
+    # reports how much it raised the peak, and with --trace-memory the peak
+    # of python's allocations during the stage (tracemalloc, which is slow)
+    if reset_traced and tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    return peakMemory()
+
+def memoryUsed(rss_started, traced=True):
+    used = {'rss_growth_kb': None if rss_started is None else peakMemory() - rss_started}
+    if traced and tracemalloc.is_tracing():
+        used['traced_peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+    return used
+
+@contextlib.contextmanager
+def stage(stage_name):
+    # time the code in the with block, which can add counts to the dict it is given, eg.
+    #   with stage('augmentImages') as counts:
+    #       ...
+    #       counts['images'] = len(recipe['images'])
+    counts = {}
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    bytes_started = output.bytes_written if output else 0
+    rss_started = memoryStarted()
+    try:
+        yield counts
+    finally:
+        stage_stats = {'stage': stage_name,
+                       'wall_ms': round((time.perf_counter() - started) * 1000, 2),
+                       'cpu_ms': round((time.process_time() - cpu_started) * 1000, 2)}
+        stage_stats.update(memoryUsed(rss_started))
+        if output and output.bytes_written > bytes_started:
+            stage_stats['bytes_written'] = output.bytes_written - bytes_started
+        stage_stats.update(counts)
+        stage_report['stages'].append(stage_stats)
+
+def writeStageReport():
+    # the slowest stages go to the log, everything to debug/stage_report.json
+    if not os.path.exists(dirs['tmp']):
+        os.makedirs(dirs['tmp'])
+    with codecs.open(join(dirs['tmp'], 'stage_report.json'), 'w', 'utf-8') as f:
+        json.dump(stage_report, f, indent=2)
+    total_ms = sum([stage_stats['wall_ms'] for stage_stats in stage_report['stages']])
+    for stage_stats in sorted(stage_report['stages'], key=lambda stage_stats: -stage_stats['wall_ms'])[:5]:
+        msg("stage %s: %.1fms (%.0f%%)" % (stage_stats['stage'], stage_stats['wall_ms'],
+                                           stage_stats['wall_ms'] * 100 / max(total_ms, 1e-6)))
+
+def cookBook(epub_file=None):
+    # run every stage of the cook, from the recipe to the .epub.
+    # epub_file may be a file object (eg. io.BytesIO) when streaming.
+    global recipe, output, epub_sha256
+    output = None
+    stage_report['stages'] = []
+    stage_report['chapters'] = []
     createEmptyDir(dirs['tmp'], False)
+    if epub_file is None:
+        epub_file = join(dirs['epub_loc'], file_name + '.epub')
+    # the served folder is emptied before the new .epub is written
+    previous_sha256 = readDigest(epub_file) if isinstance(epub_file, str) else None
+    if streaming:
+        # create served directory if it does not exist, unless cooking in memory
+        if isinstance(epub_file, str):
+            createEmptyDir(dirs['epub_loc'], False)
+        output = ZipOutput(epub_file)
+    else:
+        output = DirOutput(dirs['gen_dir'])
 
-    recipe = importYaml(file_name)
+    with stage('importYaml'):
+        recipe = importYaml(file_name)
 
-    prepareDirs(dirs)
+    with stage('optimiseImages') as counts:
+        image_sources = optimiseImages(dirs)
+        counts['images'] = len(image_sources)
 
-    recipe = checkFrontBackMatter(recipe)
+    with stage('prepareDirs') as counts:
+        counts.update(prepareDirs(dirs, image_sources))
 
-    recipe['point_of_sale'] = addPOSData('pos')
+    with stage('checkFrontBackMatter'):
+        recipe = checkFrontBackMatter(recipe)
 
-    recipe = cleanChapterMetaData(recipe)
+    with stage('addPOSData'):
+        recipe['point_of_sale'] = addPOSData(dirs['pos_data'])
+
+    with stage('cleanChapterMetaData'):
+        recipe = cleanChapterMetaData(recipe)
 
     # add data to the recipe front matter
-    recipe['front_matter'], front_matter_count = augmentFrontMatter(recipe['front_matter'])
+    with stage('augmentFrontMatter'):
+        recipe['front_matter'], front_matter_count = augmentFrontMatter(recipe['front_matter'])
 
     # prepare a dictionary of scenes
-    scenes_dict = getScenesDict(dirs['raw_book'])
+    with stage('getScenesDict') as counts:
+        scenes_dict = getScenesDict(dirs['raw_book'])
+        counts['scenes'] = sum([len(scenes) for scenes in scenes_dict.values()])
 
     # generate chapters
     # sets chapters and parts
-    recipe, next_playorder = genChapters(recipe, front_matter_count, scenes_dict)
+    with stage('genChapters') as counts:
+        recipe, next_playorder, counts['chapters'] = genChapters(recipe, front_matter_count, scenes_dict)
+        counts['scenes'] = sum([chapter_stats['scenes'] for chapter_stats in stage_report['chapters']])
+        counts['paragraphs'] = sum([chapter_stats['paragraphs'] for chapter_stats in stage_report['chapters']])
 
-    recipe['content_files'] = addContentFiles(recipe)
+    with stage('addContentFiles'):
+        recipe['content_files'] = addContentFiles(recipe)
 
     # add data to the recipe back_matter
-    recipe = augmentBackMatter(recipe, next_playorder)
+    with stage('augmentBackMatter'):
+        recipe = augmentBackMatter(recipe, next_playorder)
 
-    recipe = augmentImages(recipe)
+    with stage('augmentImages') as counts:
+        recipe = augmentImages(recipe)
+        counts['images'] = len(recipe['images'])
 
     # TODO make others follow this pattern
-    recipe['fonts'] = (augmentFonts())
+    with stage('augmentFonts') as counts:
+        recipe['fonts'] = (augmentFonts())
+        counts['fonts'] = len(recipe['fonts'])
 
-    recipe = augmentParts(recipe)
+    with stage('augmentParts'):
+        recipe = augmentParts(recipe)
 
-    recipe = genFrontBackMatter(recipe)
+    with stage('genFrontBackMatter') as counts:
+        recipe = genFrontBackMatter(recipe)
+        counts['pages'] = len(recipe['front_matter']) + len(recipe['back_matter'])
 
-    genPackageOpf(recipe) # generate the content.opf file
-    genTocNcx(recipe) # generate the ncx table of contents
+    with stage('genPackageOpf'):
+        genPackageOpf(recipe) # generate the content.opf file
+    with stage('genTocNcx'):
+        genTocNcx(recipe) # generate the ncx table of contents
 
     # write the augmented recipe to a file, just for humans to look at
-    writeAugmentedRecipe(recipe)
+    with stage('writeAugmentedRecipe'):
+        writeAugmentedRecipe(recipe)
     msg("ePubChef is finished, see /"+file_name+"_served.")
 
     # zip results into an epub file
-    epub_file = join(dirs['epub_loc'], file_name + '.epub')
-    createArchive(dirs['gen_dir'], epub_file)
-    # Optionally validate the epub
+    with stage('createArchive') as counts:
+        if streaming:
+            msg("written straight to .epub at: "+ str(epub_file))
+            output.close()
+        else:
+            createArchive(dirs['gen_dir'], epub_file)
+        if isinstance(epub_file, str):
+            counts['epub_bytes'] = os.path.getsize(epub_file)
+        else:
+            counts['epub_bytes'] = len(epub_file.getvalue())
+
+    # downstream caches can skip a cook whose sha256 they have already seen
+    with stage('digest') as counts:
+        epub_sha256 = counts['sha256'] = epubDigest(epub_file)
+        if isinstance(epub_file, str):
+            writeDigest(epub_file, epub_sha256)
+        msg("epub sha256: "+ epub_sha256 + (", the same as the last cook" if epub_sha256 == previous_sha256 else ""))
+
+    if isValidating():
+        with stage('validate') as counts:
+            counts['invalid'] = validateEpubs([epub_file if isinstance(epub_file, str) else epub_file.getvalue()])
+    saveTemplateCache()
+    logTemplateStats()
+    writeStageReport()
+    return epub_file
+
+def snapshotFiles(watched_dirs):
+    # size and modification time of every file under the watched folders
+    snapshot = {}
+    for watched_dir in watched_dirs:
+        for root, dir_names, file_names in os.walk(watched_dir):
+            for name in file_names:
+                path = join(root, name)
+                try:
+                    file_stat = os.stat(path)
+                except OSError: # removed while we looked
+                    continue
+                snapshot[path] = (file_stat.st_size, file_stat.st_mtime_ns)
+    return snapshot
+
+def watchBook(interval=0.5):
+    # keep this process (and its imports, templates and formatted scenes)
+    # warm, cooking again whenever the raw book, templates or css change.
+    # Only chapters with changed scenes are cooked again (see --incremental).
+    global incremental, keep_scenes
+    incremental = True
+    keep_scenes = True
+    watched_dirs = [dirs['raw_book'], dirs['template_dir'], dirs['css']]
+    snapshot = None
+    while True:
+        started = time.time()
+        try:
+            cookBook()
+            msg("cooked in %.2fs" % (time.time() - started,))
+        except (Exception, SystemExit) as e:
+            msg("***ERROR while cooking, fix it and save again***: "+ str(e), level=ERROR)
+        flushLog()
+        # cooking can add files (eg. empty chapters), so look after it
+        snapshot = snapshotFiles(watched_dirs)
+        msg("watching "+ dirs['raw_book'] +" for changes, Ctrl-C to stop")
+        while snapshot == snapshotFiles(watched_dirs):
+            time.sleep(interval)
+
+def profileBook():
+    # cook under cProfile, the stats go to debug/cook.pstats, eg. to look at them:
+    # python -c "import pstats; pstats.Stats('debug/cook.pstats').sort_stats('cumulative').print_stats(30)"
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        epub_file = cookBook()
+    finally:
+        profiler.disable()
+    pstats_loc = join(dirs['tmp'], 'cook.pstats')
+    profiler.dump_stats(pstats_loc)
+    top = io.StringIO()
+    pstats.Stats(profiler, stream = top).sort_stats('cumulative').print_stats(20)
+    msg(top.getvalue())
+    msg("profile written to: "+ pstats_loc)
+    return epub_file
+
+def stampPOSFile(pos_data_loc):
+    # personalize one copy from the point of sale base, without cooking the book again
+    _recipe = loadPOSBase()
+    point_of_sale = addPOSData(pos_data_loc)
+    if posDataError(point_of_sale):
+        msg("***ERROR in "+ pos_data_loc +", "+ posDataError(point_of_sale) +"***", level=ERROR)
+        raise SystemExit(2)
+    if not os.path.exists(dirs['epub_loc']):
+        os.makedirs(dirs['epub_loc'])
+    epub_file = join(dirs['epub_loc'], posEpubName(point_of_sale))
+    stampPOS(_recipe, point_of_sale, epub_file)
+    msg("stamped point of sale copy at: "+ epub_file)
+    return epub_file
+
+# "catalog" cooks every book of a catalog, a folder of <book>_raw folders or a
+# file listing one book per line (a name or a path, relative to the file, of the
+# book without _raw, lines starting with # are left out). Books are cooked in
+# --jobs worker processes, biggest first, each one with --jobs 1. The templates
+# are parsed and the shared fonts compressed once, before the workers start, and
+# a book whose raw files, templates, css, fonts, cook.py and options have not
+# changed since it was last cooked is not cooked again ("--force" cooks them all).
+# Each book logs to catalog_logs/<book>.txt and gets its own debug/<book> folder,
+# the time taken by each book goes to catalog_report.json.
+catalog_book_options = {} # options for cooking each book, set in each catalog worker
+
+def catalogBooks(catalog_loc):
+    # the (book, book folder) pairs of a catalog
+    catalog_loc = os.path.abspath(catalog_loc)
+    if os.path.isdir(catalog_loc):
+        return [(name[:-len('_raw')], catalog_loc) for name in sorted(os.listdir(catalog_loc))
+                if name.endswith('_raw') and os.path.isdir(join(catalog_loc, name))]
+    books = []
+    with codecs.open(catalog_loc, 'r', 'utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            book_path = os.path.normpath(join(os.path.dirname(catalog_loc), line))
+            books.append((os.path.basename(book_path), os.path.dirname(book_path)))
+    return books
+
+def snapshotKey(snapshot):
+    return hashlib.sha1(json.dumps(sorted(snapshot.items())).encode('utf-8')).hexdigest()
+
+def warmCatalogCaches():
+    # import the modules cooking needs, parse every template and compress the shared
+    # fonts (and logo) once, worker processes start with them (and the asset cache
+    # on disk has them)
+    import yaml
+    import markdown
+    for name in sorted(os.listdir(dirs['template_dir'])):
+        if name.endswith('.xhtml') or name.endswith('.mustache'):
+            loadTemplate(join(dirs['template_dir'], name))
+    saveTemplateCache()
+    for root, dir_names, file_names in os.walk(dirs['fonts']):
+        for name in file_names:
+            assetEntry(join(root, name), 'OEBPS/fonts/'+ name)
+    assetEntry(join(dirs['template_dir'], 'epubchef_logo.jpg'), 'OEBPS/images/epubchef_logo.jpg')
+    saveAssetIndex()
+
+def initCatalogWorker(book_options):
+    global catalog_book_options, echo
+    catalog_book_options = book_options
+    echo = False # many books at once, each book has its own log
+
+def cookCatalogBook(book, catalog_book_dir):
+    # cook one book in a catalog worker, returns what the catalog report needs
+    started = time.time()
+    result = {'book': book, 'book_dir': catalog_book_dir}
+    setupBook(book, None, None, catalog_book_options, catalog_book_dir)
+    dirs['tmp'] = join(catalog_book_dir, 'debug', book) # books share the folder
+    log_dir = join(catalog_book_dir, 'catalog_logs')
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    result['log'] = join(log_dir, book +('.jsonl' if options.get('log-json') else '.txt'))
+    openLog(result['log'], options.get('log-json', False), options.get('log-level', 'info'))
+    template_stats.clear()
+    del validation_results[:]
+    try:
+        epub_file = cookBook()
+        result['status'] = 'cooked'
+        result['epub'] = epub_file
+        result['epub_bytes'] = os.path.getsize(epub_file)
+        result['sha256'] = epub_sha256
+        if [validation for validation in validation_results if not validation['valid']]:
+            result['status'] = 'failed'
+            result['error'] = 'not a valid epub'
+    except (Exception, SystemExit) as e:
+        msg("***ERROR while cooking***: "+ repr(e), level=ERROR)
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+    finally:
+        closeLog()
+    result['seconds'] = round(time.time() - started, 3)
+    return result
+
+def cookCatalog(catalog_loc):
+    # cook the books of a catalog which changed, returns the number which failed
+    books = catalogBooks(catalog_loc)
+    catalog_dir = catalog_loc if os.path.isdir(catalog_loc) else os.path.dirname(os.path.abspath(catalog_loc))
+    manifest_loc = join(catalog_dir, 'catalog_manifest.json')
+    try:
+        with open(manifest_loc, 'r') as f:
+            catalog_manifest = json.load(f)
+    except:
+        catalog_manifest = {}
+    # each book is cooked with the catalog's options, one process each
+    book_options = dict([(option, value) for option, value in options.items()
+                         if option not in ['jobs', 'force', 'log']])
+    started = time.time()
+
+    # inputs shared by every book, looked at once
+    shared_snapshot = snapshotFiles([dirs['template_dir'], dirs['css'], dirs['fonts']])
+    cook_stat = os.stat(os.path.realpath(__file__))
+    shared_snapshot['cook.py'] = (cook_stat.st_size, cook_stat.st_mtime_ns)
+    shared_key = snapshotKey(shared_snapshot) + json.dumps(dict([(option, value)
+        for option, value in book_options.items() if option not in ['log-level', 'log-json']]), sort_keys=True)
+
+    report = []
+    to_cook = []
+    for book, catalog_book_dir in books:
+        raw_snapshot = snapshotFiles([join(catalog_book_dir, book +'_raw')])
+        book_key = hashlib.sha1((shared_key + snapshotKey(raw_snapshot)).encode('utf-8')).hexdigest()
+        manifest_entry = catalog_manifest.get(join(catalog_book_dir, book), {})
+        epub_file = join(catalog_book_dir, book +'_served', book +'.epub')
+        if not options.get('force') and manifest_entry.get('key') == book_key and os.path.isfile(epub_file):
+            report.append({'book': book, 'book_dir': catalog_book_dir, 'status': 'unchanged',
+                           'seconds': 0, 'epub': epub_file, 'sha256': readDigest(epub_file)})
+            continue
+        raw_bytes = sum([file_stat[0] for file_stat in raw_snapshot.values()])
+        to_cook.append((raw_bytes, book, catalog_book_dir, book_key))
+    msg("catalog: %d books, %d to cook, %d unchanged" % (len(books), len(to_cook), len(books) - len(to_cook)))
+
+    if to_cook:
+        # the biggest books first, so a big book doesn't start last and hold up the end
+        to_cook.sort(key=lambda book_entry: -book_entry[0])
+        warmCatalogCaches()
+        book_keys = dict([((book, catalog_book_dir), book_key)
+                          for raw_bytes, book, catalog_book_dir, book_key in to_cook])
+        flushLog() # don't let worker processes inherit unwritten log lines
+        # --jobs books at a time, otherwise one per cpu
+        processes = jobs if 'jobs' in options else multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(min(max(processes, 1), len(to_cook)),
+                                    initializer = initCatalogWorker, initargs = (book_options,))
+        try:
+            for result in pool.starmap(cookCatalogBook, [(book, catalog_book_dir)
+                                       for raw_bytes, book, catalog_book_dir, book_key in to_cook], chunksize = 1):
+                report.append(result)
+                if result['status'] == 'cooked':
+                    catalog_manifest[join(result['book_dir'], result['book'])] = \
+                        {'key': book_keys[(result['book'], result['book_dir'])], 'seconds': result['seconds']}
+                else:
+                    catalog_manifest.pop(join(result['book_dir'], result['book']), None)
+        finally:
+            pool.close()
+            pool.join()
+        with open(manifest_loc, 'w') as f:
+            json.dump(catalog_manifest, f, indent=1, sort_keys=True)
+    elapsed = time.time() - started
+
+    report.sort(key=lambda result: -result['seconds'])
+    for result in report:
+        msg("book %s: %s in %.2fs%s" % (result['book'], result['status'], result['seconds'],
+            (', %s, see %s' % (result['error'], result['log'])) if 'error' in result else ''))
+    failed = len([result for result in report if result['status'] == 'failed'])
+    cooked_seconds = sum([result['seconds'] for result in report])
+    msg("catalog cooked in %.2fs (%.2fs of cooking, %d failed), report at: %s" % (elapsed, cooked_seconds,
+        failed, join(catalog_dir, 'catalog_report.json')))
+    with codecs.open(join(catalog_dir, 'catalog_report.json'), 'w', 'utf-8') as f:
+        json.dump({'seconds': round(elapsed, 3), 'books': report}, f, indent=2)
+    return failed
+
+# cook.py keeps the book being cooked in module globals, so one book cooks at a time.
+kitchen_lock = threading.RLock()
+
+class Kitchen(object):
+    # cook a book from another python program rather than the command line, eg.
+    #   from cook import Kitchen
+    #   epub_path = Kitchen('demo').cook()
+    #   epub_bytes = Kitchen('demo', jobs=4).cook(in_memory=True)
+    # mode is one of the command line modes (debug, pos, ...), the other
+    # keyword arguments are the command line options, eg. template_cache=True.
+    # log_file is a file name or a file object, eg. io.StringIO() to keep the log in memory.
+    # After a cook, kitchen.sha256 is the sha256 of the .epub (see --deterministic).
+    # Kitchens can be used from several threads, cooks take turns.
+    def __init__(self, book, book_dir=None, mode=None, log_file=None, **book_options):
+        self.book = book
+        self.book_dir = book_dir
+        self.mode = mode
+        self.log_file = log_file
+        self.sha256 = None
+        self.options = {}
+        for option, value in book_options.items():
+            if value:
+                self.options[option.replace('_', '-')] = value
+
+    def setup(self, extra_options={}):
+        if self.log_file:
+            openLog(self.log_file, self.options.get('log-json', False), self.options.get('log-level', 'info'))
+        setupBook(self.book, self.mode, None, dict(self.options, **extra_options), self.book_dir)
+
+    def cook(self, in_memory=False):
+        # returns the path of the .epub, or its bytes when in_memory
+        with kitchen_lock:
+            try:
+                if in_memory:
+                    self.setup({'stream': True})
+                    epub_file = cookBook(io.BytesIO()).getvalue()
+                else:
+                    self.setup()
+                    epub_file = cookBook()
+                self.sha256 = epub_sha256
+                if self.mode == 'pos':
+                    writePOSBase(recipe)
+                return epub_file
+            finally:
+                closeLog()
+
+    def stamp(self, point_of_sale, in_memory=False):
+        # personalize one copy from the base written by Kitchen(book, mode='pos').cook(),
+        # point_of_sale is a dictionary like the book's _pos_data.txt
+        if posDataError(point_of_sale):
+            raise ValueError(posDataError(point_of_sale))
+        with kitchen_lock:
+            try:
+                self.setup()
+                _recipe = loadPOSBase()
+                if in_memory:
+                    return stampPOS(_recipe, point_of_sale, io.BytesIO()).getvalue()
+                if not os.path.exists(dirs['epub_loc']):
+                    os.makedirs(dirs['epub_loc'])
+                return stampPOS(_recipe, point_of_sale, join(dirs['epub_loc'], posEpubName(point_of_sale)))
+            finally:
+                closeLog()
+
+#########################################################################
+if __name__ == "__main__": # main processing
+
+    args, cmd_options = parseArgs(sys.argv)
+    log_loc = cmd_options.get('log') or join(cook_dir, 'cook_log.jsonl' if cmd_options.get('log-json') else 'cook_log.txt')
+    openLog(log_loc, cmd_options.get('log-json', False), cmd_options.get('log-level', 'info'))
+    # book name, then optionally a mode (debug, validate, ...) and its argument
+    setupBook(args[0], (args[1:2] or [None])[0], (args[2:3] or [None])[0], cmd_options)
+    msg('cook_dir: '+ cook_dir)
+
+    if arg2 == 'bench':
+        regressions = runBenchmarks()
+        msg("All done\n")
+        raise SystemExit(1 if regressions else 0)
+
+    if arg2 == 'catalog':
+        failed = cookCatalog(args[0])
+        msg("All done\n")
+        raise SystemExit(1 if failed else 0)
+
+    if arg2 == 'synth':
+        writeSyntheticBook(bookShape())
+        msg("All done\n")
+        raise SystemExit
+
+    if arg2 == 'watch':
+        try:
+            watchBook()
+        except KeyboardInterrupt:
+            msg("All done\n")
+        raise SystemExit
+
+    # "stamp" personalizes a copy from the base written by "pos",
+    # eg. python cook.py demo stamp demo_raw/demo_pos_data.txt
+    if arg2 == 'stamp':
+        stampPOSFile(arg3 or dirs['pos_data'])
+        msg("All done\n")
+        raise SystemExit
+
+    if arg2 == 'batch' and not (arg3 and isfile(arg3)):
+        msg("***ERROR, batch needs a file of point of sale records, eg. python cook.py "
+            + file_name +" batch sales.jsonl***", level=ERROR)
+        raise SystemExit(2)
+
+    if arg2 == 'profile':
+        epub_file = profileBook()
+    else:
+        epub_file = cookBook()
+
+    # "pos" also writes the point of sale base so copies can be stamped quickly
+    if arg2 in ['pos', 'batch', 'serve']:
+        writePOSBase(recipe)
+
+    if arg2 == 'serve':
+        try:
+            serveBooks(int(options.get('port', 8000)), int(options.get('workers', 0)),
+                       int(options['queue']) if 'queue' in options else None)
+        except KeyboardInterrupt:
+            msg("All done\n")
+        raise SystemExit
+
+    if arg2 == 'batch':
+        epub_paths = stampBatch(arg3)
+        if options.get('validate'):
+            validateEpubs(epub_paths)
+
+    # Optionally validate the epub (cookBook does, see validateEpubs)
     # NOTE: epubcheck is not part of ePubChef and we won't be offended if you don't run
     # it from here.
     # To validate, install the Java JDK on your machine, set your PATH to include java, and put the epubcheck jar file in the folder above this one.
     # execute cook.py with an additional argument, "python cook.py validate"
-    if arg2 in ['validate','kindlegen']:
-        epubPath = join(dirs['epub_loc'], file_name + '.epub')
-        epubcheck('../epubcheck/epubcheck.jar', epubPath )
 
     # Optionally run kindlgen to create a .mobi
     # NOTE: kindlgen is not part of ePubChef and we won't be offended if you don't run
@@ -1002,4 +3544,6 @@ if __name__ == "__main__": # main processing
             kindlegen('..\kindlegen_win32_v2_9\kindlegen', epub_file )
 
     msg("All done\n")
-    log.close
+    closeLog()
+    if [result for result in validation_results if not result['valid']]:
+        raise SystemExit(1)
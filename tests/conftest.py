@@ -0,0 +1,34 @@
+# the tests import cook.py from the folder above
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shutil
+
+import pytest
+
+import cook
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # every test starts with empty caches, outside the source tree
+    monkeypatch.setenv('EPUBCHEF_CACHE_DIR', str(tmp_path / 'cache'))
+    return str(tmp_path / 'cache')
+
+
+@pytest.fixture
+def demo_dir(tmp_path):
+    # a folder with a copy of the demo book, to cook with Kitchen('demo', book_dir=...)
+    shutil.copytree(os.path.join(cook.cook_dir, 'demo_raw'), str(tmp_path / 'demo_raw'))
+    return str(tmp_path)
+
+
+@pytest.fixture
+def cook_folder(tmp_path):
+    # a copy of cook.py with the demo book, to run from the command line in
+    for name in ['templates', 'css', 'fonts', 'demo_raw']:
+        shutil.copytree(os.path.join(cook.cook_dir, name), str(tmp_path / name))
+    shutil.copy(os.path.join(cook.cook_dir, 'cook.py'), str(tmp_path))
+    return str(tmp_path)
@@ -0,0 +1,53 @@
+import re
+
+import pytest
+
+import cook
+
+
+def test_options_anywhere_after_the_book():
+    args, options = cook.parseArgs(['cook.py', 'demo', '--jobs', '4', 'batch', '--stream', 'sales.jsonl'])
+    assert args == ['demo', 'batch', 'sales.jsonl']
+    assert options == {'jobs': '4', 'stream': True}
+
+
+@pytest.mark.parametrize('argv', [
+    ['cook.py', 'demo', '--jobs'],          # no value
+    ['cook.py', 'demo', '--jobs', 'x'],     # not a number
+    ['cook.py', 'demo', '--port', '80a'],
+    ['cook.py', 'demo', '--workers', '2.5'],
+    ['cook.py', 'demo', '--queue', ''],
+    ['cook.py', 'demo', '--tolerance', 'y'],
+    ['cook.py', 'demo', '--jobs', '0'],     # out of bounds
+    ['cook.py', 'demo', '--queue', '-1'],
+    ['cook.py', 'demo', '--port', '70000'],
+    ['cook.py', 'demo', '--markdown', '1.5'],
+    ['cook.py', 'demo', '--log-level', 'loud'],
+    ['cook.py'],                            # no book
+    ])
+def test_bad_arguments_exit_with_usage(argv):
+    with pytest.raises(SystemExit) as exit_info:
+        cook.parseArgs(argv)
+    assert exit_info.value.code == 2
+
+
+def test_options_at_their_bounds():
+    args, options = cook.parseArgs(['cook.py', 'demo', 'serve', '--queue', '0', '--port', '65535', '--markdown', '1'])
+    assert options == {'queue': '0', 'port': '65535', 'markdown': '1'}
+
+
+@pytest.mark.parametrize('argv', [
+    ['cook.py', 'demo', '--job', '4'],
+    ['cook.py', 'demo', '--stram'],
+    ])
+def test_unknown_options_exit_with_usage(argv):
+    with pytest.raises(SystemExit) as exit_info:
+        cook.parseArgs(argv)
+    assert exit_info.value.code == 2
+
+
+def test_every_option_used_is_known():
+    with open(cook.__file__) as f:
+        source = f.read()
+    used = set(re.findall(r"options\.get\('([a-z-]+)'", source))
+    assert used <= set(cook.value_options + cook.flag_options)
@@ -0,0 +1,74 @@
+import glob
+import io
+import json
+import os
+import zipfile
+
+import cook
+
+
+def cookDemo(demo_dir):
+    with open(cook.Kitchen('demo', book_dir=demo_dir, deterministic=True).cook(), 'rb') as f:
+        return f.read()
+
+
+def addSvg(demo_dir):
+    # the demo's jpgs are stored as they are, an svg deflates
+    lines = ''.join('<circle cx="%d" cy="10" r="5"/>\n' % x for x in range(200))
+    with open(os.path.join(demo_dir, 'demo_raw', 'images', 'circles.svg'), 'w') as f:
+        f.write('<svg xmlns="http://www.w3.org/2000/svg">\n' + lines + '</svg>\n')
+
+
+def test_missing_deflate_blob_is_compressed_again(demo_dir):
+    addSvg(demo_dir)
+    first = cookDemo(demo_dir)
+    blobs = glob.glob(os.path.join(cook.dirs['asset_cache'], '*.deflate'))
+    assert blobs
+    for blob in blobs:
+        os.remove(blob)
+
+    assert cookDemo(demo_dir) == first
+    for blob in blobs:
+        assert os.path.exists(blob)
+
+
+def test_writestr_fallback_gives_the_same_epub(demo_dir, monkeypatch):
+    addSvg(demo_dir)
+    first = cookDemo(demo_dir)
+    monkeypatch.setattr(cook, 'raw_zip_copy', False)
+    assert cookDemo(demo_dir) == first
+
+
+def test_index_forgets_files_which_are_gone(demo_dir, cache_dir):
+    addSvg(demo_dir)
+    cookDemo(demo_dir)
+    index_file = os.path.join(cache_dir, 'index.json')
+    with open(index_file) as f:
+        index = json.load(f)
+    index['files']['/no/such/folder/image.jpg'] = [1, 1, 'f' * 40]
+    index['entries']['f' * 40] = {'crc': 0, 'file_size': 1, 'compress_type': 8, 'compress_size': 1}
+    with open(index_file, 'w') as f:
+        json.dump(index, f)
+    orphan = os.path.join(cache_dir, 'f' * 40 + '.deflate')
+    with open(orphan, 'wb') as f:
+        f.write(b'x')
+    os.utime(orphan, (0, 0))
+
+    cook.asset_index = None
+    cookDemo(demo_dir)
+    with open(index_file) as f:
+        index = json.load(f)
+    assert '/no/such/folder/image.jpg' not in index['files']
+    assert 'f' * 40 not in index['entries']
+    assert not os.path.exists(orphan)
+    assert glob.glob(os.path.join(cache_dir, '*.deflate')) # the svg's blob is kept
+
+
+def test_stream_leaves_out_files_which_are_not_images(demo_dir):
+    with open(os.path.join(demo_dir, 'demo_raw', 'images', 'notes.txt'), 'w') as f:
+        f.write('not part of the book\n')
+    epub = cook.Kitchen('demo', book_dir=demo_dir).cook(in_memory=True)
+    with zipfile.ZipFile(io.BytesIO(epub)) as book:
+        assert 'OEBPS/images/notes.txt' not in book.namelist()
+        assert 'OEBPS/images/jazz_frog.jpg' in book.namelist()
+    assert cook.checkStructure(epub) == ([], [])
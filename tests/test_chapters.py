@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import cook
+
+
+def test_custom_template_can_loop_over_the_scenes_twice(cook_folder, monkeypatch):
+    template_path = os.path.join(cook_folder, 'templates', 'chapter.xhtml')
+    with open(template_path) as f:
+        template = f.read()
+    template = template.replace('{{{words}}}', '{{{words}}}<!--first-->')
+    template = template.replace('</section>', '{{#scenes}}{{#paras}}<!--second-->{{/paras}}{{/scenes}}'
+                                '{{^scenes}}<!--no scenes-->{{/scenes}}</section>')
+    with open(template_path, 'w') as f:
+        f.write(template)
+    monkeypatch.setattr(cook, 'cook_dir', cook_folder)
+
+    cook.Kitchen('demo', book_dir=cook_folder).cook()
+    with open(os.path.join(cook_folder, 'demo_cooked', 'OEBPS', 'content', 'chap002.xhtml')) as f:
+        chapter = f.read()
+    assert chapter.count('<!--first-->') > 1
+    assert chapter.count('<!--second-->') == chapter.count('<!--first-->')
+    assert '<!--no scenes-->' not in chapter
+
+
+def demoChapters(demo_dir):
+    # the demo book's chapters with their scenes, as renderChapter gives them to the template
+    cook.setupBook('demo', None, None, {}, demo_dir)
+    cook.recipe = cook.importYaml('demo')
+    scenes_dict = cook.getScenesDict(cook.dirs['raw_book'])
+    counts = {'paragraphs': 0}
+    return [dict(chapter, scenes=list(cook.chapterScenes(scenes_dict[chapter['code']], counts, False)))
+            for chapter in cook.recipe['chapters']]
+
+
+@pytest.mark.parametrize('chapter_nbr', range(len(cook.chapter_samples)))
+def test_direct_xhtml_matches_the_template_for_samples(demo_dir, chapter_nbr):
+    cook.setupBook('demo', None, None, {}, demo_dir)
+    chapter = cook.chapter_samples[chapter_nbr]
+    assert cook.directChapterXhtml(chapter) == cook.templateChapterXhtml(chapter)
+
+
+def test_direct_xhtml_matches_the_template_for_the_demo(demo_dir):
+    chapters = demoChapters(demo_dir)
+    assert chapters
+    for chapter in chapters:
+        assert cook.directChapterXhtml(chapter) == cook.templateChapterXhtml(chapter), chapter['code']
+
+
+def test_bench_fails_when_the_golden_check_does(demo_dir, monkeypatch):
+    cook.setupBook('demo', 'bench', None, {'repeat': '1'}, demo_dir)
+    assert cook.runBenchmarks() == 0
+    monkeypatch.setattr(cook, 'directChapterXhtml', lambda chapter: 'not the same')
+    assert cook.runBenchmarks() > 0
@@ -0,0 +1,24 @@
+import os
+
+import cook
+
+
+def test_unchanged_raw_images_are_not_hashed_again(demo_dir, monkeypatch):
+    recipe_path = os.path.join(demo_dir, 'demo_raw', 'demo_recipe.txt')
+    with open(recipe_path, 'rb') as f:
+        recipe_text = f.read()
+    with open(recipe_path, 'wb') as f:
+        f.write(b'optimise_images: true\n' + recipe_text)
+    cook.Kitchen('demo', book_dir=demo_dir).cook()
+
+    hashed = []
+    hash_file = cook.hashFile
+    monkeypatch.setattr(cook, 'hashFile', lambda path: hashed.append(path) or hash_file(path))
+    cook.Kitchen('demo', book_dir=demo_dir).cook()
+    raw_images = os.path.join(demo_dir, 'demo_raw', 'images')
+    assert not [path for path in hashed if path.startswith(raw_images)]
+
+    frog = os.path.join(raw_images, 'jazz_frog.jpg')
+    os.utime(frog, ns=(0, os.stat(frog).st_mtime_ns + 10**9))
+    cook.Kitchen('demo', book_dir=demo_dir).cook()
+    assert [path for path in hashed if path.startswith(raw_images)] == [frog]
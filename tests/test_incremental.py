@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+import cook
+
+
+def test_failed_cook_leaves_chapters_to_cook_again(demo_dir, monkeypatch):
+    kitchen = cook.Kitchen('demo', book_dir=demo_dir, incremental=True)
+    kitchen.cook()
+    scene = os.path.join(demo_dir, 'demo_raw', '_020_0020_markdown.txt')
+    with open(scene, 'a') as f:
+        f.write('\nA line added after the first cook.\n')
+
+    def fail(*args):
+        raise RuntimeError('interrupted')
+    write_chapter = cook.writeChapter
+    monkeypatch.setattr(cook, 'writeChapter', fail)
+    with pytest.raises(RuntimeError):
+        kitchen.cook()
+    monkeypatch.setattr(cook, 'writeChapter', write_chapter)
+
+    kitchen.cook()
+    with open(os.path.join(demo_dir, 'demo_cooked', 'OEBPS', 'content', 'chap002.xhtml')) as f:
+        assert 'A line added after the first cook.' in f.read()
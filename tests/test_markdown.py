@@ -0,0 +1,38 @@
+import pytest
+
+import cook
+
+# scenes which markdown could render differently in one pass than paragraph by paragraph
+tricky_scenes = [
+    ['* one', '* two', 'A paragraph after the list, with *emphasis*.'],
+    ['1. first', '2. second', '', 'Text after a numbered list.'],
+    ['<div class="note">', 'inside a block', '</div>', 'after the block'],
+    ['<p>raw html paragraph</p>', 'then **markdown**'],
+    ['See [the site][1] for more.', '[1]: http://example.com/', 'And [again][1].'],
+    ['[Inline](http://example.com/ "a title") and <em>inline html</em>.'],
+    ['| a | b |', '|---|---|', '| 1 | 2 |'],
+    ['# Heading', 'Text with `code` and a trailing break  ', '> a quote'],
+    ['"Quotes" -- dashes... and & ampersands', "It's Bob's."],
+    ]
+
+
+def demoScenes(demo_dir):
+    cook.setupBook('demo', None, None, {}, demo_dir)
+    cook.recipe = cook.importYaml('demo')
+    scenes_dict = cook.getScenesDict(cook.dirs['raw_book'])
+    return [cook.readSceneLines(scene_name)
+            for chapter_code in sorted(scenes_dict) for scene_name in scenes_dict[chapter_code]]
+
+
+@pytest.mark.parametrize('lines', tricky_scenes)
+def test_scene_markdown_matches_paragraph_markdown(lines):
+    assert cook.formatScene(lines, 0, True, batch_markdown=True) == \
+        cook.formatScene(lines, 0, True, batch_markdown=False)
+
+
+def test_scene_markdown_matches_paragraph_markdown_for_the_demo(demo_dir):
+    scenes = demoScenes(demo_dir)
+    assert scenes
+    for lines in scenes:
+        assert cook.formatScene(lines, 0, True, batch_markdown=True) == \
+            cook.formatScene(lines, 0, True, batch_markdown=False)
@@ -0,0 +1,60 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+import cook
+
+
+def test_base_from_the_command_line_stamps_from_the_module(cook_folder):
+    # the CLI pickles the base recipe as __main__, the module API loads it as cook
+    subprocess.check_call([sys.executable, 'cook.py', 'demo', 'pos'], cwd=cook_folder,
+                          stdout=subprocess.DEVNULL)
+
+    point_of_sale = {'purchaser': 'Jo Reader', 'transaction_id': 'abc123', 'price': '$4.99'}
+    epub = cook.Kitchen('demo', book_dir=cook_folder).stamp(point_of_sale, in_memory=True)
+    with zipfile.ZipFile(io.BytesIO(epub)) as book:
+        assert any('Jo Reader' in book.read(name).decode('utf-8')
+                   for name in book.namelist() if name.endswith('.xhtml'))
+
+
+def test_in_memory_pos_cook_returns_the_epub_and_writes_the_base(demo_dir):
+    epub = cook.Kitchen('demo', book_dir=demo_dir, mode='pos').cook(in_memory=True)
+    with zipfile.ZipFile(io.BytesIO(epub)) as book:
+        assert 'OEBPS/package.opf' in book.namelist()
+    assert os.path.isfile(cook.dirs['pos_base'])
+
+
+def test_in_memory_cook_leaves_the_served_folder_alone(demo_dir):
+    served = cook.Kitchen('demo', book_dir=demo_dir).cook()
+    cook.Kitchen('demo', book_dir=demo_dir).cook(in_memory=True)
+    assert os.path.isfile(served)
+
+
+@pytest.mark.parametrize('records', [
+    [{'purchaser': 'Jo Reader', 'transaction_id': 't1'}, {'transaction_id': '../../escaped'}],
+    [{'transaction_id': 't1\r\nSet-Cookie: injected=1'}],
+    ['just a string'],
+    ['a transaction_id in a string'],
+    ])
+def test_batch_rejects_bad_records_before_stamping(demo_dir, records):
+    sales = os.path.join(demo_dir, 'sales.json')
+    with open(sales, 'w') as f:
+        json.dump(records, f)
+    cook.setupBook('demo', 'batch', sales, {}, demo_dir)
+    with pytest.raises(SystemExit) as exit_info:
+        cook.stampBatch(sales)
+    assert exit_info.value.code == 2
+    assert not os.path.exists(cook.dirs['epub_loc'])
+
+
+def test_stamp_rejects_unsafe_transaction_ids(demo_dir):
+    with pytest.raises(ValueError):
+        cook.Kitchen('demo', book_dir=demo_dir).stamp({'transaction_id': '../escaped'})
+    with pytest.raises(ValueError):
+        cook.posEpubName({'transaction_id': 'a/b'}, 'demo')
+    assert cook.posEpubName({'transaction_id': 'frt553tge3ss6'}, 'demo') == 'demo_frt553tge3ss6.epub'
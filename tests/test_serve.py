@@ -0,0 +1,80 @@
+import http.client
+import io
+import json
+import signal
+import socket
+import subprocess
+import sys
+import time
+import zipfile
+
+import pytest
+
+
+@pytest.fixture
+def server(cook_folder):
+    # python cook.py demo serve on a free port, stopped with Ctrl-C
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([sys.executable, 'cook.py', 'demo', 'serve', '--port', str(port),
+                                '--workers', '1', '--queue', '0'],
+                               cwd=cook_folder, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            break
+        except OSError:
+            assert process.poll() is None and time.time() < deadline, 'the server did not start'
+            time.sleep(0.1)
+    yield port
+    process.send_signal(signal.SIGINT)
+    process.wait(10)
+
+
+def post(port, body, headers=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    connection.putrequest('POST', '/demo')
+    for name, value in (headers or {'Content-Length': str(len(body))}).items():
+        connection.putheader(name, value)
+    connection.endheaders()
+    connection.send(body)
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def test_stamps_a_copy(server):
+    status, body = post(server, json.dumps({'purchaser': 'Jo Reader', 'transaction_id': 't1'}).encode('utf-8'))
+    assert status == 200
+    with zipfile.ZipFile(io.BytesIO(body)) as book:
+        assert any('Jo Reader' in book.read(name).decode('utf-8')
+                   for name in book.namelist() if name.endswith('.xhtml'))
+
+
+@pytest.mark.parametrize('body, headers', [
+    (b'{}', {'Content-Length': 'two'}),
+    (b'{}', {'Content-Length': '-1'}),
+    (b'purchaser: \xff\xfe', None),  # not UTF-8
+    (b'["a list"]', None),
+    (json.dumps({'transaction_id': 't1\r\nSet-Cookie: injected=1'}).encode('utf-8'), None),
+    (b'transaction_id: ../escaped', None),
+    ])
+def test_bad_requests(server, body, headers):
+    status, body = post(server, body, headers)
+    assert status == 400
+    assert 'error' in json.loads(body.decode('utf-8'))
+
+
+def test_bodies_over_the_cap_are_not_read(server):
+    status, body = post(server, b'', {'Content-Length': str(10 ** 9)})
+    assert status == 413
+
+
+def test_metrics(server):
+    post(server, b'{"purchaser": "Jo Reader"}')
+    connection = http.client.HTTPConnection('127.0.0.1', server, timeout=30)
+    connection.request('GET', '/metrics')
+    metrics = json.loads(connection.getresponse().read().decode('utf-8'))
+    assert metrics['requests'] == 1
+    assert metrics['in_flight'] == 0 and metrics['waiting'] == 0
@@ -0,0 +1,24 @@
+import tracemalloc
+
+import cook
+
+
+def stageStats(name):
+    return [stats for stats in cook.stage_report['stages'] if stats['stage'] == name][0]
+
+
+def test_prepare_dirs_counts_the_bytes_it_copies(demo_dir):
+    cook.Kitchen('demo', book_dir=demo_dir, copy_assets=True).cook()
+    assert stageStats('prepareDirs')['bytes_written'] > 0
+
+
+def test_stages_report_their_own_memory(demo_dir):
+    try:
+        cook.Kitchen('demo', book_dir=demo_dir, trace_memory=True).cook()
+    finally:
+        tracemalloc.stop()
+    for stats in cook.stage_report['stages']:
+        assert 'peak_rss_kb' not in stats
+        assert stats['rss_growth_kb'] is None or stats['rss_growth_kb'] >= 0
+    # the small stages peak far below the whole cook
+    assert stageStats('addPOSData')['traced_peak_kb'] < stageStats('genChapters')['traced_peak_kb']
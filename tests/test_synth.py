@@ -0,0 +1,13 @@
+import yaml
+
+import cook
+
+
+def test_every_part_starts_at_a_chapter(tmp_path):
+    cook.setupBook('big', 'synth', None, {'chapters': '3', 'parts': '5', 'scenes': '1', 'paras': '2'},
+                   str(tmp_path))
+    cook.writeSyntheticBook(cook.bookShape())
+    with open(cook.dirs['recipe_loc']) as f:
+        recipe = yaml.safe_load(f)
+    started = [chapter['starts_part'] for chapter in recipe['chapters'] if 'starts_part' in chapter]
+    assert started == [part['part_name'] for part in recipe['parts']]
@@ -0,0 +1,90 @@
+# golden tests for postMarkdownTextClean, the one pass typography engine,
+# against the chain of replaces it replaced (kept here as the reference).
+import re
+
+import pytest
+
+import cook
+
+
+def postMarkdownTextCleanChain(line):
+    # the original sequence of replaces
+    line = line.replace('...',"&#8230;")
+    line = line.replace("&rsquo;","&#8217;") # right single quote
+    line = line.replace("&lsquo;","&#8216;") # left single quote
+    line = line.replace("&pound;","&#163;") # pound sign
+
+    # left double quotes
+    line = line.replace(' "'," &#8220;")
+    if line[0:4] == '<p>"':
+        line = line.replace('"',"&#8220;", 1)
+    line = line.replace('<a &#8220;','<a "') # undo smart quotes on xhtml links
+
+    # right double quotes
+    line = line.replace('" ',"&#8221; ")
+    line = line.replace('."',".&#8221;")
+    line = line.replace('?"',"?&#8221;")
+    line = line.replace('!"',"!&#8221;")
+    # undo smart quotes on image xhtml links
+    line = line.replace('.jpg&#8221;','.jpg"')
+    line = line.replace('.png&#8221;','.png"')
+    line = line.replace('&#8221;/>','"/>')
+    line = line.replace('&#8221; />','" />')
+    line = line.replace('&#8221; alt=','" alt=')
+    line = line.replace('&#8221; src=','" src=')
+
+    # left single quotes
+    line = line.replace(" '"," &#8216;")
+    if line[0:4] == "<p>'":
+        line = line.replace("'","&#8216;", 1)
+
+    # right single quotes
+    line = line.replace("' ","&#8217; ")
+    line = line.replace(".'",".&#8217;")
+
+    # ampersands
+    line = re.sub(r'&(?![#a-zA-Z0-9]+?;)', "&#38;", line)
+    line = line.replace(" &amp; "," &#38; ")
+
+    # double spaces to single
+    line = line.replace("  "," ")
+    return line
+
+
+@pytest.mark.parametrize('line', cook.typography_samples)
+def test_samples_match_the_chain(line):
+    assert cook.postMarkdownTextClean(line) == postMarkdownTextCleanChain(line)
+
+
+@pytest.mark.parametrize('line, expected', [
+    ('<p>"Hello," she said. "Goodbye."</p>',
+     '<p>&#8220;Hello,&#8221; she said. &#8220;Goodbye.&#8221;</p>'),
+    ("<p>'Tis the season, 'quoted' he said.' It's Bob's.</p>",
+     "<p>&#8216;Tis the season, &#8216;quoted&#8217; he said.&#8217; It's Bob's.</p>"),
+    ('<p>Wait... "What..." and... "Really?" "Yes!" ok</p>',
+     '<p>Wait&#8230; &#8220;What&#8230;&#8221; and&#8230; &#8220;Really?&#8221; &#8220;Yes!&#8221; ok</p>'),
+    ('<p>Fish &amp; chips, AT&T, &pound;5, &rsquo;ello</p>',
+     '<p>Fish &#38; chips, AT&#38;T, &#163;5, &#8217;ello</p>'),
+    ('<p>Double  spaces   here</p>', '<p>Double spaces  here</p>'),
+    ('<p><img alt="frog" src="images/jazz_frog.jpg" /> text</p>',
+     '<p><img alt="frog" src="images/jazz_frog.jpg" /> text</p>'),
+    ('no typography at all', 'no typography at all'),
+    ])
+def test_golden(line, expected):
+    assert cook.postMarkdownTextClean(line) == expected
+
+
+# Where the engine and the chain differ, the chain's "undo" replaces for
+# links and images also hit quotes in the text, the engine leaves tags
+# alone and treats text as text.
+@pytest.mark.parametrize('line, expected', [
+    ('<p>He said "the file.jpg" is fine.</p>',
+     '<p>He said &#8220;the file.jpg&#8221; is fine.</p>'),
+    ('<p>See "a.png" now</p>', '<p>See &#8220;a.png&#8221; now</p>'),
+    ('<p>Type "x" alt= here</p>', '<p>Type &#8220;x&#8221; alt= here</p>'),
+    ('<p>"Quote" src= in text</p>', '<p>&#8220;Quote&#8221; src= in text</p>'),
+    ('<p>A <a href="x" title="a. b">l</a></p>', '<p>A <a href="x" title="a. b">l</a></p>'),
+    ])
+def test_engine_differs_from_the_chain(line, expected):
+    assert cook.postMarkdownTextClean(line) == expected
+    assert postMarkdownTextCleanChain(line) != expected
@@ -0,0 +1,48 @@
+import os
+import stat
+
+import pytest
+
+import cook
+
+
+def fakeEpubcheck(folder, version, output, returncode):
+    # an epubcheck on the PATH which prints its version, or output and exits with returncode
+    os.makedirs(folder)
+    script = os.path.join(folder, 'epubcheck')
+    with open(script, 'w') as f:
+        f.write('#!/bin/sh\n'
+                'if [ "$1" = "--version" ]; then echo "%s"; exit 0; fi\n'
+                'echo "%s"\n'
+                'exit %d\n' % (version, output, returncode))
+    os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+    return folder
+
+
+def validateTwice(demo_dir):
+    results = []
+    for attempt in range(2):
+        cook.validation_results[:] = []
+        cook.Kitchen('demo', book_dir=demo_dir, validate=True, deterministic=True).cook()
+        results.append(cook.validation_results[0])
+    return results
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='the fake epubcheck is a shell script')
+def test_results_of_a_finished_check_are_cached(demo_dir, monkeypatch):
+    bin_dir = fakeEpubcheck(os.path.join(demo_dir, 'bin'), 'EPUBCheck v0.0.1',
+                            'Messages: 0 fatals / 0 errors / 0 warnings / 0 infos', 0)
+    monkeypatch.setenv('PATH', bin_dir + os.pathsep + os.environ['PATH'])
+    first, second = validateTwice(demo_dir)
+    assert first['valid'] and not first['cached']
+    assert second['valid'] and second['cached']
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='the fake epubcheck is a shell script')
+def test_results_of_a_failed_run_are_not_cached(demo_dir, monkeypatch):
+    bin_dir = fakeEpubcheck(os.path.join(demo_dir, 'bin'), 'EPUBCheck v0.0.2',
+                            'Error: Unable to access jarfile epubcheck.jar', 1)
+    monkeypatch.setenv('PATH', bin_dir + os.pathsep + os.environ['PATH'])
+    first, second = validateTwice(demo_dir)
+    assert not first['valid'] and not first['cached']
+    assert not second['valid'] and not second['cached']